@@ -1,3 +1,7 @@
 from .bfl_nodes import NODE_CLASS_MAPPINGS, NODE_DISPLAY_NAME_MAPPINGS
+from .bfl_utils import register_server_routes, resume_pending_tasks
+
+register_server_routes()
+resume_pending_tasks()
 
 __all__ = ['NODE_CLASS_MAPPINGS', 'NODE_DISPLAY_NAME_MAPPINGS']
\ No newline at end of file
@@ -0,0 +1,93 @@
+# Benchmark de decodificación de resultados: compara la ruta anterior
+# (abrir, re-codificar en output_format, volver a abrir y convertir) con
+# la ruta directa bytes -> tensor de bfl_utils.
+#
+# Uso: python benchmarks/bench_decode.py [--size 2048] [--format jpeg] [--runs 10] [--max-size 0]
+import argparse
+import io
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import torch
+from PIL import Image
+
+import bfl_utils
+
+def make_sample(size, fmt):
+    # Ruido suave para que el tamaño comprimido se parezca al de una imagen real
+    rng = np.random.default_rng(0)
+    small = rng.integers(0, 256, (size // 16, size // 16, 3), dtype=np.uint8)
+    img = Image.fromarray(small).resize((size, size), Image.BICUBIC)
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt.upper(), quality=95)
+    return buffer.getvalue()
+
+def legacy_decode(data, output_format, max_size=None):
+    img = Image.open(io.BytesIO(data))
+    with io.BytesIO() as buffer:
+        img.save(buffer, format=output_format.upper())
+        buffer.seek(0)
+        img_array = np.array(Image.open(buffer)).astype(np.float32) / 255.0
+        return torch.from_numpy(img_array)[None,]
+
+def direct_decode(data, output_format, max_size=None):
+    return bfl_utils.decode_image(data, max_size=max_size)
+
+VARIANTS = {
+    'legacy': legacy_decode,
+    'direct': direct_decode,
+}
+
+def run_variant(name, size, fmt, runs, max_size):
+    data = make_sample(size, fmt)
+    decode = VARIANTS[name]
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        tensor = decode(data, fmt, max_size or None)
+        timings.append(time.perf_counter() - start)
+        del tensor
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings.sort()
+    print(
+        f"{name:>8}  {size}px {fmt:<4}  bytes={len(data):>9}  "
+        f"median={timings[len(timings) // 2] * 1000:8.1f}ms  "
+        f"min={timings[0] * 1000:8.1f}ms  "
+        f"peak_rss_delta={(peak_rss - baseline_rss) / 1024:8.1f}MB"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark BFL result decoding")
+    parser.add_argument('--size', type=int, default=2048)
+    parser.add_argument('--format', choices=['jpeg', 'png'], default='jpeg')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-size', type=int, default=0, help="decodificación reducida (solo ruta directa)")
+    parser.add_argument('--variant', choices=list(VARIANTS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        run_variant(args.variant, args.size, args.format, args.runs, args.max_size)
+        return
+
+    # Cada variante corre en su propio proceso para que el pico de memoria sea comparable
+    for name in VARIANTS:
+        subprocess.run([
+            sys.executable, os.path.abspath(__file__),
+            '--variant', name,
+            '--size', str(args.size),
+            '--format', args.format,
+            '--runs', str(args.runs),
+            '--max-size', str(args.max_size if name == 'direct' else 0),
+        ], check=True)
+
+if __name__ == '__main__':
+    main()
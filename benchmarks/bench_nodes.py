@@ -0,0 +1,194 @@
+# Benchmark de extremo a extremo de todos los nodos contra el servidor local
+# de benchmarks/mock_bfl_server.py. Mide throughput, latencia p50/p95/p99,
+# consultas por trabajo y pico de memoria para varios niveles de concurrencia
+# y resoluciones de entrada.
+#
+# Uso: python benchmarks/bench_nodes.py --concurrency 1,4,16 --resolutions 512,1024 --jobs 16
+import argparse
+import concurrent.futures
+import importlib
+import importlib.util
+import os
+import resource
+import socket
+import sys
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import torch
+
+from mock_bfl_server import MockBFLServer, MockSettings
+
+def load_package(server, args):
+    # Los nodos usan imports relativos: se importa el paquete por el nombre de su
+    # carpeta. El paquete se registra sin ejecutar su __init__ (que crea el diario
+    # de tareas y el pool de keys) hasta haber fijado la configuración, para que
+    # nunca se llegue a la API real ni se usen la caché o el diario
+    name = os.path.basename(ROOT)
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(ROOT, "__init__.py"), submodule_search_locations=[ROOT]
+    )
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[name] = package
+    utils = importlib.import_module(f"{name}.bfl_utils")
+
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+
+    utils.BFLConfigLoader().config.read_dict({
+        'API': {'X_KEY': 'benchmark-key', 'BASE_URL': server.base_url + '/v1/'},
+        'CACHE': {'ENABLED': 'false'},
+        'JOURNAL': {'ENABLED': 'false'},
+        'RATE_LIMIT': {'SUBMITS_PER_SECOND': str(args.submit_rate), 'MAX_ACTIVE_TASKS': str(args.max_active)},
+        # El servidor simulado es local: la URL de loopback se indica explícitamente
+        'WEBHOOK': {
+            'ENABLED': str(args.webhook).lower(), 'LISTEN': f"127.0.0.1:{port}",
+            'URL': f"http://127.0.0.1:{port}/bfl/webhook",
+        },
+    })
+    spec.loader.exec_module(package)
+    return package, utils
+
+def sample_inputs(node_class, resolution):
+    # Entradas de prueba a partir de INPUT_TYPES: valores por defecto y tensores aleatorios
+    input_types = node_class.INPUT_TYPES()
+    kwargs = {}
+    for section in ("required", "optional"):
+        for name, spec in input_types.get(section, {}).items():
+            kind = spec[0]
+            options = spec[1] if len(spec) > 1 else {}
+            if kind == "IMAGE":
+                kwargs[name] = torch.rand(1, resolution, resolution, 3)
+            elif kind == "MASK":
+                mask = torch.zeros(1, resolution, resolution)
+                mask[:, resolution // 4:resolution // 2, resolution // 4:resolution // 2] = 1.0
+                kwargs[name] = mask
+            elif isinstance(kind, list):
+                kwargs[name] = options.get("default", kind[0])
+            elif kind == "STRING":
+                kwargs[name] = options.get("default") or "benchmark prompt"
+            elif kind in ("INT", "FLOAT", "BOOLEAN"):
+                if section == "required" or "default" in options:
+                    kwargs[name] = options.get("default", 0)
+            elif kind == "BFL_RESULT":
+                continue
+            else:
+                return None
+    # Semilla aleatoria para que ninguna petición se sirva desde caché
+    kwargs["seed"] = -1
+    kwargs["x_key"] = ""
+    return kwargs
+
+def runnable_nodes(package):
+    nodes = {}
+    collect = package.NODE_CLASS_MAPPINGS.get("BFL Collect")
+    for name, node_class in package.NODE_CLASS_MAPPINGS.items():
+        if node_class.RETURN_TYPES[0] == "IMAGE" or (node_class.RETURN_TYPES == ("BFL_TASK",) and collect):
+            nodes[name] = node_class
+    return nodes, collect
+
+def run_job(node_class, collect_class, kwargs):
+    if "sweep" in kwargs:
+        # Las semillas de la matriz son fijas: un prompt distinto en cada ejecución
+        # evita que trabajos idénticos se unan a uno ya en curso. Flux 1.1 ignora
+        # guidance, así que el segundo eje usa un parámetro que sí llega al payload
+        kwargs = dict(
+            kwargs, prompt=f"{kwargs['prompt']} {uuid.uuid4().hex[:8]}", sweep="seed = 1..4\nsafety_tolerance = 0..3"
+        )
+    node = node_class()
+    start = time.perf_counter()
+    result = getattr(node, node_class.FUNCTION)(**kwargs)[0]
+    if node_class.RETURN_TYPES == ("BFL_TASK",):
+        result = collect_class().collect(task=result)[0]
+    return time.perf_counter() - start, tuple(result.shape)
+
+def percentile(values, q):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+def jobs_by_status(utils):
+    totals = {}
+    for (metric, labels), value in list(utils.BFLMetrics().series.items()):
+        if metric == "bfl_jobs_total":
+            status = dict(labels).get("status")
+            totals[status] = totals.get(status, 0) + value
+    return totals
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark BFL nodes against a local mock API")
+    parser.add_argument('--nodes', default='', help="nombres de NODE_CLASS_MAPPINGS separados por comas (todos por defecto)")
+    parser.add_argument('--concurrency', default='1,4,16')
+    parser.add_argument('--resolutions', default='512,1024')
+    parser.add_argument('--jobs', type=int, default=16, help="trabajos por combinación")
+    parser.add_argument('--duration', type=float, default=2.0, help="tiempo medio de generación simulado")
+    parser.add_argument('--jitter', type=float, default=0.25)
+    parser.add_argument('--submit-latency', type=float, default=0.05)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--moderation-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--poll-throttle-rate', type=float, default=0.0)
+    parser.add_argument('--poll-unavailable-rate', type=float, default=0.0)
+    parser.add_argument('--image-size', type=int, default=1024, help="tamaño del resultado simulado")
+    parser.add_argument('--submit-rate', type=float, default=1000.0)
+    parser.add_argument('--max-active', type=int, default=1000)
+    parser.add_argument('--webhook', action='store_true', help="avisos por webhook en lugar de polling")
+    parser.add_argument('--webhook-loss-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    settings = MockSettings(
+        submit_latency=args.submit_latency, duration=args.duration, jitter=args.jitter,
+        failure_rate=args.failure_rate, moderation_rate=args.moderation_rate,
+        throttle_rate=args.throttle_rate, image_size=args.image_size,
+        poll_throttle_rate=args.poll_throttle_rate, poll_unavailable_rate=args.poll_unavailable_rate,
+        webhook_loss_rate=args.webhook_loss_rate,
+    )
+    server = MockBFLServer(settings).start()
+    package, utils = load_package(server, args)
+    nodes, collect_class = runnable_nodes(package)
+    if args.nodes:
+        selected = [name.strip() for name in args.nodes.split(',')]
+        nodes = {name: nodes[name] for name in selected}
+
+    print(f"{'node':<30} {'res':>5} {'conc':>5} {'jobs':>5} {'thr/s':>7} {'p50':>7} {'p95':>7} {'p99':>7} "
+          f"{'polls/job':>9} {'failed':>6} {'rss_MB':>8}")
+
+    for name, node_class in nodes.items():
+        for resolution in [int(r) for r in args.resolutions.split(',')]:
+            kwargs = sample_inputs(node_class, resolution)
+            if kwargs is None:
+                continue
+            for concurrency in [int(c) for c in args.concurrency.split(',')]:
+                before = server.stats.snapshot()
+                failed_before = jobs_by_status(utils).get("error", 0)
+
+                start = time.perf_counter()
+                with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+                    results = list(pool.map(
+                        lambda _: run_job(node_class, collect_class, kwargs), range(args.jobs)
+                    ))
+                elapsed = time.perf_counter() - start
+
+                after = server.stats.snapshot()
+                latencies = [latency for latency, _ in results]
+                polls = after["polls"] - before["polls"]
+                submits = max(1, after["submits"] - before["submits"])
+                failed = jobs_by_status(utils).get("error", 0) - failed_before
+                peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+                print(
+                    f"{name:<30} {resolution:>5} {concurrency:>5} {args.jobs:>5} "
+                    f"{args.jobs / elapsed:>7.2f} {percentile(latencies, 0.5):>7.2f} "
+                    f"{percentile(latencies, 0.95):>7.2f} {percentile(latencies, 0.99):>7.2f} "
+                    f"{polls / submits:>9.2f} {failed:>6} {peak_rss:>8.1f}"
+                )
+
+    server.stop()
+
+if __name__ == '__main__':
+    main()
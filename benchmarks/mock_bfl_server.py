@@ -0,0 +1,320 @@
+# Servidor local que imita la API de BFL para medir el rendimiento sin gastar
+# créditos: endpoints de envío (429, 503), get_result (Pending con progreso,
+# Ready, Error, moderación, 429, 503) y descarga del resultado (con Range y
+# cortes simulados). Si el envío incluye webhook_url, al terminar la tarea se
+# envía el aviso firmado (se puede simular su pérdida).
+#
+# Uso standalone: python benchmarks/mock_bfl_server.py --port 8765 --duration 5
+import argparse
+import hashlib
+import hmac
+import io
+import json
+import random
+import re
+import threading
+import time
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+class MockSettings:
+    def __init__(self, submit_latency=0.05, duration=3.0, jitter=0.25, queue_fraction=0.2,
+                 failure_rate=0.0, moderation_rate=0.0, throttle_rate=0.0, unavailable_rate=0.0, retry_after=1.0,
+                 poll_throttle_rate=0.0, poll_unavailable_rate=0.0,
+                 image_size=1024, image_format='jpeg', truncate_rate=0.0, range_support=True, webhook_loss_rate=0.0,
+                 signature_header='X-BFL-Signature'):
+        self.submit_latency = submit_latency
+        self.duration = duration
+        self.jitter = jitter
+        self.queue_fraction = queue_fraction
+        self.failure_rate = failure_rate
+        self.moderation_rate = moderation_rate
+        self.throttle_rate = throttle_rate
+        self.unavailable_rate = unavailable_rate
+        self.retry_after = retry_after
+        self.poll_throttle_rate = poll_throttle_rate
+        self.poll_unavailable_rate = poll_unavailable_rate
+        self.image_size = image_size
+        self.image_format = image_format
+        self.truncate_rate = truncate_rate
+        self.range_support = range_support
+        self.webhook_loss_rate = webhook_loss_rate
+        self.signature_header = signature_header
+
+class MockStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {
+            "submits": 0,
+            "throttled": 0,
+            "unavailable": 0,
+            "polls": 0,
+            "poll_throttled": 0,
+            "poll_unavailable": 0,
+            "downloads": 0,
+            "truncated": 0,
+            "ranged": 0,
+            "ready": 0,
+            "errors": 0,
+            "moderated": 0,
+            "callbacks": 0,
+            "callbacks_lost": 0,
+        }
+
+    def increment(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+class MockBFLServer:
+    def __init__(self, settings=None, host='127.0.0.1', port=0):
+        self.settings = settings or MockSettings()
+        self.stats = MockStats()
+        self.tasks = {}
+        self.samples = {}
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mock-bfl-server", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def sample_bytes(self):
+        # Una imagen por tamaño y formato, generada una sola vez
+        key = (self.settings.image_size, self.settings.image_format)
+        with self.lock:
+            if key not in self.samples:
+                size = self.settings.image_size
+                small = Image.effect_noise((max(1, size // 16), max(1, size // 16)), 64).convert('RGB')
+                img = small.resize((size, size), Image.BICUBIC)
+                buffer = io.BytesIO()
+                img.save(buffer, format=self.settings.image_format.upper(), quality=95)
+                self.samples[key] = buffer.getvalue()
+            return self.samples[key]
+
+    def schedule_callback(self, task_id, host, payload):
+        webhook_url = payload.get('webhook_url')
+        if not webhook_url:
+            return
+        if random.random() < self.settings.webhook_loss_rate:
+            self.stats.increment("callbacks_lost")
+            return
+        with self.lock:
+            _, duration, _ = self.tasks[task_id]
+        timer = threading.Timer(
+            duration, self.send_callback, (task_id, host, webhook_url, payload.get('webhook_secret') or '')
+        )
+        timer.daemon = True
+        timer.start()
+
+    def send_callback(self, task_id, host, webhook_url, secret):
+        # Mismo formato que get_result, firmado con HMAC-SHA256 del cuerpo
+        body = json.dumps(self.task_status(task_id, host)).encode('utf-8')
+        signature = "sha256=" + hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+        request = urllib.request.Request(webhook_url, data=body, method='POST', headers={
+            'Content-Type': 'application/json', self.settings.signature_header: signature,
+        })
+        try:
+            urllib.request.urlopen(request, timeout=10).close()
+            self.stats.increment("callbacks")
+        except Exception:
+            self.stats.increment("callbacks_lost")
+
+    def create_task(self):
+        settings = self.settings
+        duration = max(0.0, random.gauss(settings.duration, settings.duration * settings.jitter))
+        roll = random.random()
+        if roll < settings.failure_rate:
+            outcome = 'Error'
+        elif roll < settings.failure_rate + settings.moderation_rate:
+            outcome = random.choice(['Request Moderated', 'Content Moderated'])
+        else:
+            outcome = 'Ready'
+
+        task_id = uuid.uuid4().hex
+        with self.lock:
+            self.tasks[task_id] = (time.monotonic(), duration, outcome)
+        return task_id
+
+    def task_status(self, task_id, host):
+        with self.lock:
+            task = self.tasks.get(task_id)
+        if task is None:
+            return {"id": task_id, "status": "Task not found"}
+
+        created, duration, outcome = task
+        elapsed = time.monotonic() - created
+        if elapsed < duration:
+            # Durante la fase de cola la API no informa progreso
+            queued = duration * self.settings.queue_fraction
+            progress = None if elapsed < queued else round(100 * (elapsed - queued) / (duration - queued), 1)
+            return {"id": task_id, "status": "Pending", "progress": progress}
+
+        if outcome == 'Ready':
+            self.stats.increment("ready")
+            extension = 'jpg' if self.settings.image_format == 'jpeg' else self.settings.image_format
+            return {
+                "id": task_id,
+                "status": "Ready",
+                "result": {"sample": f"http://{host}/samples/{task_id}.{extension}"},
+            }
+        if outcome == 'Error':
+            self.stats.increment("errors")
+            return {"id": task_id, "status": "Error", "details": "Simulated generation failure"}
+        self.stats.increment("moderated")
+        return {"id": task_id, "status": outcome}
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, code, body, content_type='application/json', headers=None):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_sample(self, body):
+                content_type = f"image/{server.settings.image_format}"
+                start = 0
+                match = re.match(r"bytes=(\d+)-", self.headers.get('Range', ''))
+                if match and server.settings.range_support:
+                    server.stats.increment("ranged")
+                    start = int(match.group(1))
+                    self.send_response(206)
+                    self.send_header('Content-Range', f"bytes {start}-{len(body) - 1}/{len(body)}")
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body) - start))
+                self.send_header('Accept-Ranges', 'bytes' if server.settings.range_support else 'none')
+                self.end_headers()
+                if start == 0 and random.random() < server.settings.truncate_rate:
+                    # Corte de conexión a mitad del cuerpo
+                    server.stats.increment("truncated")
+                    self.wfile.write(body[:len(body) // 2])
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+                self.wfile.write(body[start:])
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    payload = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    payload = {}
+                time.sleep(server.settings.submit_latency)
+
+                if random.random() < server.settings.unavailable_rate:
+                    server.stats.increment("unavailable")
+                    self._send(503, {"detail": "Service Unavailable"})
+                    return
+
+                if random.random() < server.settings.throttle_rate:
+                    server.stats.increment("throttled")
+                    self._send(
+                        429, {"detail": "Too many active tasks"},
+                        headers={'Retry-After': str(server.settings.retry_after)}
+                    )
+                    return
+
+                server.stats.increment("submits")
+                task_id = server.create_task()
+                host = self.headers.get('Host')
+                server.schedule_callback(task_id, host, payload)
+                self._send(200, {
+                    "id": task_id,
+                    "polling_url": f"http://{host}/v1/get_result?id={task_id}",
+                })
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path.endswith('/get_result'):
+                    server.stats.increment("polls")
+                    if random.random() < server.settings.poll_unavailable_rate:
+                        server.stats.increment("poll_unavailable")
+                        self._send(503, {"detail": "Service Unavailable"})
+                        return
+                    if random.random() < server.settings.poll_throttle_rate:
+                        server.stats.increment("poll_throttled")
+                        self._send(
+                            429, {"detail": "Too many requests"},
+                            headers={'Retry-After': str(server.settings.retry_after)}
+                        )
+                        return
+                    task_id = parse_qs(url.query).get('id', [''])[0]
+                    self._send(200, server.task_status(task_id, self.headers.get('Host')))
+                elif url.path.startswith('/samples/'):
+                    server.stats.increment("downloads")
+                    self._send_sample(server.sample_bytes())
+                else:
+                    self._send(404, {"detail": "Not Found"})
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the BFL API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--submit-latency', type=float, default=0.05)
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--jitter', type=float, default=0.25)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--moderation-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--unavailable-rate', type=float, default=0.0)
+    parser.add_argument('--poll-throttle-rate', type=float, default=0.0)
+    parser.add_argument('--poll-unavailable-rate', type=float, default=0.0)
+    parser.add_argument('--image-size', type=int, default=1024)
+    parser.add_argument('--image-format', choices=['jpeg', 'png'], default='jpeg')
+    parser.add_argument('--truncate-rate', type=float, default=0.0)
+    parser.add_argument('--webhook-loss-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    settings = MockSettings(
+        submit_latency=args.submit_latency, duration=args.duration, jitter=args.jitter,
+        failure_rate=args.failure_rate, moderation_rate=args.moderation_rate,
+        throttle_rate=args.throttle_rate, unavailable_rate=args.unavailable_rate,
+        poll_throttle_rate=args.poll_throttle_rate, poll_unavailable_rate=args.poll_unavailable_rate,
+        image_size=args.image_size, image_format=args.image_format,
+        truncate_rate=args.truncate_rate, webhook_loss_rate=args.webhook_loss_rate,
+    )
+    server = MockBFLServer(settings, host=args.host, port=args.port)
+    print(f"Mock BFL API listening on {server.base_url}/v1/")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
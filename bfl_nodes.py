@@ -1,6 +1,8 @@
 from .bfl_utils import *
-import requests
 import torch
+import json
+import math
+import concurrent.futures
 
 class BFL_ImageGenerator:
     @classmethod
@@ -18,57 +20,63 @@ class BFL_ImageGenerator:
             "optional": {
                 "seed": ("INT", {"default": 30}),
                 "image_prompt": ("IMAGE",),
+                "image_prompt_result": ("BFL_RESULT",),
                 "steps": ("INT", {"default": 40, "min": 15, "max": 50}),
                 "guidance": ("FLOAT", {"default": 2.5, "min": 1.0, "max": 100.0}),
-            }
+                "timeout": ("INT", {"default": 0, "min": 0, "max": 3600}),
+                **SCHEDULING_INPUTS,
+                "max_size": ("INT", {"default": 0, "min": 0, "max": 8192, "step": 64}),
+                **OUTPUT_INPUTS,
+            },
         }
     
-    RETURN_TYPES = ("IMAGE",)
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        return inputs_fingerprint(kwargs)
+
+    RETURN_TYPES = ("IMAGE", "BFL_RESULT", "IMAGE", "STRING")
+    RETURN_NAMES = ("image", "result", "preview", "path")
     FUNCTION = "generate"
     CATEGORY = "BFL/Generation"
+    BATCH_INPUTS = ("image_prompt",)
+
+    def build_request(self, **kwargs):
+        endpoint = "flux-pro-1.1" if kwargs['api_version'] == "1.1" else "flux-pro"
+        
+        payload = {
+            "prompt": kwargs['prompt'],
+            "width": kwargs['width'],
+            "height": kwargs['height'],
+            "safety_tolerance": kwargs['safety_tolerance'],
+            "output_format": kwargs['output_format'],
+            "seed": kwargs['seed'] if kwargs['seed'] != -1 else None,
+        }
+        
+        if kwargs['api_version'] == "1.0":
+            payload.update({
+                "steps": kwargs.get('steps', 40),
+                "guidance": kwargs.get('guidance', 2.5),
+            })
+        
+        if 'image_prompt' in kwargs and kwargs['image_prompt'] is not None:
+            payload['image_prompt'] = image_to_base64(kwargs['image_prompt'], endpoint=endpoint, field='image_prompt')
+        
+        return endpoint, payload
 
     def generate(self, **kwargs):
         try:
-            config = BFLConfigLoader()
-            endpoint = "flux-pro-1.1" if kwargs['api_version'] == "1.1" else "flux-pro"
-            
-            payload = {
-                "prompt": kwargs['prompt'],
-                "width": kwargs['width'],
-                "height": kwargs['height'],
-                "safety_tolerance": kwargs['safety_tolerance'],
-                "output_format": kwargs['output_format'],
-                "seed": kwargs['seed'] if kwargs['seed'] != -1 else None,
-            }
-            
-            if kwargs['api_version'] == "1.0":
-                payload.update({
-                    "steps": kwargs.get('steps', 40),
-                    "guidance": kwargs.get('guidance', 2.5),
-                })
-            
-            if 'image_prompt' in kwargs and kwargs['image_prompt'] is not None:
-                payload['image_prompt'] = image_to_base64(kwargs['image_prompt'])
-            
-            response = requests.post(
-                url=f"https://api.us1.bfl.ai/v1/{endpoint}",
-                headers={"x-key": config.get_api_key(kwargs['x_key']), "Content-Type": "application/json"},
-                json={k: v for k, v in payload.items() if v is not None},
-                timeout=30
-            )
-            
-            return (handle_api_response(response, kwargs['output_format'], kwargs['x_key']),)
+            results = execute_batch(self.build_request, kwargs, self.BATCH_INPUTS)
+            return node_outputs(results, kwargs)
         
         except Exception as e:
             print(f"BFL Generation Error: {str(e)}")
-            return (create_error_image(),)
+            return (create_error_image(), None, create_error_image(), "")
 
 class BFL_Inpainting:
     @classmethod
     def INPUT_TYPES(cls):
         return {
             "required": {
-                "image": ("IMAGE",),
                 "mask": ("MASK",),
                 "prompt": ("STRING", {"multiline": True}),
                 "steps": ("INT", {"default": 50, "min": 15, "max": 50}),
@@ -78,41 +86,72 @@ class BFL_Inpainting:
                 "x_key": ("STRING", {"default": ""}),
             },
             "optional": {
+                "image": ("IMAGE",),
+                "image_result": ("BFL_RESULT",),
                 "seed": ("INT", {"default": -1}),
-            }
+                "crop_to_mask": ("BOOLEAN", {"default": False}),
+                "crop_padding": ("INT", {"default": 64, "min": 0, "max": 1024}),
+                "feather": ("INT", {"default": 16, "min": 0, "max": 256}),
+                "tiled": ("BOOLEAN", {"default": False}),
+                "tile_size": ("INT", {"default": 1024, "min": 256, "max": 2048, "step": 32}),
+                "tile_overlap": ("INT", {"default": 128, "min": 0, "max": 512}),
+                "timeout": ("INT", {"default": 0, "min": 0, "max": 3600}),
+                **SCHEDULING_INPUTS,
+                "max_size": ("INT", {"default": 0, "min": 0, "max": 8192, "step": 64}),
+                **OUTPUT_INPUTS,
+            },
         }
     
-    RETURN_TYPES = ("IMAGE",)
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        return inputs_fingerprint(kwargs)
+
+    RETURN_TYPES = ("IMAGE", "BFL_RESULT", "IMAGE", "STRING")
+    RETURN_NAMES = ("image", "result", "preview", "path")
     FUNCTION = "inpaint"
     CATEGORY = "BFL/Inpainting"
+    BATCH_INPUTS = ("image", "mask")
+
+    def build_request(self, **kwargs):
+        if kwargs.get('image') is None:
+            raise Exception("An image or image_result input is required")
+
+        endpoint = "flux-pro-1.0-fill"
+        payload = {
+            "image": image_to_base64(kwargs['image'], endpoint=endpoint, field='image'),
+            "mask": mask_to_base64(kwargs['mask'], endpoint=endpoint),
+            "prompt": kwargs['prompt'],
+            "steps": kwargs['steps'],
+            "guidance": kwargs['guidance'],
+            "output_format": kwargs['output_format'],
+            "safety_tolerance": kwargs['safety_tolerance'],
+            "seed": kwargs['seed'] if kwargs['seed'] != -1 else None,
+        }
+        
+        return endpoint, payload
+
+    def submit_regions(self, kwargs):
+        # Solo se envía el recorte alrededor de la máscara (crop_to_mask)
+        return submit_masked_regions(
+            self.build_request, kwargs,
+            padding=kwargs.get('crop_padding', 64), feather=kwargs.get('feather', 16)
+        )
 
     def inpaint(self, **kwargs):
         try:
-            config = BFLConfigLoader()
-            
-            payload = {
-                "image": image_to_base64(kwargs['image']),
-                "mask": mask_to_base64(kwargs['mask']),
-                "prompt": kwargs['prompt'],
-                "steps": kwargs['steps'],
-                "guidance": kwargs['guidance'],
-                "output_format": kwargs['output_format'],
-                "safety_tolerance": kwargs['safety_tolerance'],
-                "seed": kwargs['seed'] if kwargs['seed'] != -1 else None,
-            }
-            
-            response = requests.post(
-                url="https://api.us1.bfl.ai/v1/flux-pro-1.0-fill",
-                headers={"x-key": config.get_api_key(kwargs['x_key']), "Content-Type": "application/json"},
-                json={k: v for k, v in payload.items() if v is not None},
-                timeout=30
-            )
-            
-            return (handle_api_response(response, kwargs['output_format'], kwargs['x_key']),)
+            if kwargs.get('tiled'):
+                results = collect_tasks([submit_tiled(
+                    self.build_request, kwargs, self.BATCH_INPUTS, kwargs['tile_size'], kwargs['tile_overlap']
+                )])
+            elif kwargs.get('crop_to_mask'):
+                results = collect_tasks([self.submit_regions(kwargs)])
+            else:
+                results = execute_batch(self.build_request, kwargs, self.BATCH_INPUTS)
+            return node_outputs(results, kwargs)
         
         except Exception as e:
             print(f"BFL Inpainting Error: {str(e)}")
-            return (create_error_image(),)
+            return (create_error_image(), None, create_error_image(), "")
 
 class BFL_CannyControl:
     @classmethod
@@ -133,52 +172,65 @@ class BFL_CannyControl:
                 "preprocessed_image": ("IMAGE",),
                 "seed": ("INT", {"default": -1}),
                 "prompt_upsampling": ("BOOLEAN", {"default": False}),
-            }
+                "tiled": ("BOOLEAN", {"default": False}),
+                "tile_size": ("INT", {"default": 1024, "min": 256, "max": 2048, "step": 32}),
+                "tile_overlap": ("INT", {"default": 128, "min": 0, "max": 512}),
+                "timeout": ("INT", {"default": 0, "min": 0, "max": 3600}),
+                **SCHEDULING_INPUTS,
+                "max_size": ("INT", {"default": 0, "min": 0, "max": 8192, "step": 64}),
+                **OUTPUT_INPUTS,
+            },
         }
     
-    RETURN_TYPES = ("IMAGE",)
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        return inputs_fingerprint(kwargs)
+
+    RETURN_TYPES = ("IMAGE", "BFL_RESULT", "IMAGE", "STRING")
+    RETURN_NAMES = ("image", "result", "preview", "path")
     FUNCTION = "generate"
     CATEGORY = "BFL/ControlNet"
+    BATCH_INPUTS = ("control_image", "preprocessed_image")
+
+    def build_request(self, **kwargs):
+        endpoint = "flux-pro-1.0-canny"
+        payload = {
+            "prompt": kwargs['prompt'],
+            "control_image": image_to_base64(kwargs['control_image'], endpoint=endpoint, field='control_image'),
+            "canny_low_threshold": kwargs['canny_low'],
+            "canny_high_threshold": kwargs['canny_high'],
+            "steps": kwargs['steps'],
+            "guidance": kwargs['guidance'],
+            "output_format": kwargs['output_format'],
+            "safety_tolerance": kwargs['safety_tolerance'],
+            "seed": kwargs['seed'] if kwargs['seed'] != -1 else None,
+            "prompt_upsampling": kwargs.get('prompt_upsampling', False),
+        }
+        
+        if kwargs.get('preprocessed_image') is not None:
+            payload['preprocessed_image'] = image_to_base64(kwargs['preprocessed_image'], endpoint=endpoint, field='preprocessed_image')
+        
+        return endpoint, payload
 
     def generate(self, **kwargs):
         try:
-            config = BFLConfigLoader()
-            
-            payload = {
-                "prompt": kwargs['prompt'],
-                "control_image": image_to_base64(kwargs['control_image']),
-                "canny_low_threshold": kwargs['canny_low'],
-                "canny_high_threshold": kwargs['canny_high'],
-                "steps": kwargs['steps'],
-                "guidance": kwargs['guidance'],
-                "output_format": kwargs['output_format'],
-                "safety_tolerance": kwargs['safety_tolerance'],
-                "seed": kwargs['seed'] if kwargs['seed'] != -1 else None,
-                "prompt_upsampling": kwargs.get('prompt_upsampling', False),
-            }
-            
-            if kwargs.get('preprocessed_image'):
-                payload['preprocessed_image'] = image_to_base64(kwargs['preprocessed_image'])
-            
-            response = requests.post(
-                url="https://api.us1.bfl.ai/v1/flux-pro-1.0-canny",
-                headers={"x-key": config.get_api_key(kwargs['x_key']), "Content-Type": "application/json"},
-                json=payload,
-                timeout=30
-            )
-            
-            return (handle_api_response(response, kwargs['output_format'], kwargs['x_key']),)
+            if kwargs.get('tiled'):
+                results = collect_tasks([submit_tiled(
+                    self.build_request, kwargs, self.BATCH_INPUTS, kwargs['tile_size'], kwargs['tile_overlap']
+                )])
+            else:
+                results = execute_batch(self.build_request, kwargs, self.BATCH_INPUTS)
+            return node_outputs(results, kwargs)
         
         except Exception as e:
             print(f"BFL Canny Error: {str(e)}")
-            return (create_error_image(),)
+            return (create_error_image(), None, create_error_image(), "")
 
 class BFL_ImageExpander:
     @classmethod
     def INPUT_TYPES(cls):
         return {
             "required": {
-                "image": ("IMAGE",),
                 "top": ("INT", {"default": 0, "min": 0, "max": 2048}),
                 "bottom": ("INT", {"default": 0, "min": 0, "max": 2048}),
                 "left": ("INT", {"default": 0, "min": 0, "max": 2048}),
@@ -191,46 +243,57 @@ class BFL_ImageExpander:
                 "x_key": ("STRING", {"default": ""}),
             },
             "optional": {
+                "image": ("IMAGE",),
+                "image_result": ("BFL_RESULT",),
                 "seed": ("INT", {"default": -1}),
                 "prompt_upsampling": ("BOOLEAN", {"default": False}),
-            }
+                "timeout": ("INT", {"default": 0, "min": 0, "max": 3600}),
+                **SCHEDULING_INPUTS,
+                "max_size": ("INT", {"default": 0, "min": 0, "max": 8192, "step": 64}),
+                **OUTPUT_INPUTS,
+            },
         }
     
-    RETURN_TYPES = ("IMAGE",)
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        return inputs_fingerprint(kwargs)
+
+    RETURN_TYPES = ("IMAGE", "BFL_RESULT", "IMAGE", "STRING")
+    RETURN_NAMES = ("image", "result", "preview", "path")
     FUNCTION = "expand"
     CATEGORY = "BFL/Expansion"
+    BATCH_INPUTS = ("image",)
+
+    def build_request(self, **kwargs):
+        if kwargs.get('image') is None:
+            raise Exception("An image or image_result input is required")
+
+        endpoint = "flux-pro-1.0-expand"
+        payload = {
+            "image": image_to_base64(kwargs['image'], endpoint=endpoint, field='image'),
+            "top": kwargs['top'],
+            "bottom": kwargs['bottom'],
+            "left": kwargs['left'],
+            "right": kwargs['right'],
+            "prompt": kwargs['prompt'],
+            "steps": kwargs['steps'],
+            "guidance": kwargs['guidance'],
+            "output_format": kwargs['output_format'],
+            "safety_tolerance": kwargs['safety_tolerance'],
+            "seed": kwargs['seed'] if kwargs['seed'] != -1 else None,
+            "prompt_upsampling": kwargs.get('prompt_upsampling', False),
+        }
+        
+        return endpoint, payload
 
     def expand(self, **kwargs):
         try:
-            config = BFLConfigLoader()
-            
-            payload = {
-                "image": image_to_base64(kwargs['image']),
-                "top": kwargs['top'],
-                "bottom": kwargs['bottom'],
-                "left": kwargs['left'],
-                "right": kwargs['right'],
-                "prompt": kwargs['prompt'],
-                "steps": kwargs['steps'],
-                "guidance": kwargs['guidance'],
-                "output_format": kwargs['output_format'],
-                "safety_tolerance": kwargs['safety_tolerance'],
-                "seed": kwargs['seed'] if kwargs['seed'] != -1 else None,
-                "prompt_upsampling": kwargs.get('prompt_upsampling', False),
-            }
-            
-            response = requests.post(
-                url="https://api.us1.bfl.ai/v1/flux-pro-1.0-expand",
-                headers={"x-key": config.get_api_key(kwargs['x_key']), "Content-Type": "application/json"},
-                json={k: v for k, v in payload.items() if v is not None},
-                timeout=30
-            )
-            
-            return (handle_api_response(response, kwargs['output_format'], kwargs['x_key']),)
+            results = execute_batch(self.build_request, kwargs, self.BATCH_INPUTS)
+            return node_outputs(results, kwargs)
         
         except Exception as e:
             print(f"BFL Expansion Error: {str(e)}")
-            return (create_error_image(),)
+            return (create_error_image(), None, create_error_image(), "")
 
 class BFL_FluxKontext:
     @classmethod
@@ -245,47 +308,53 @@ class BFL_FluxKontext:
             },
             "optional": {
                 "input_image": ("IMAGE",),
+                "input_image_result": ("BFL_RESULT",),
                 "seed": ("INT", {"default": -1}),
                 "aspect_ratio": ("STRING", {"default": ""}),
                 "prompt_upsampling": ("BOOLEAN", {"default": False}),
-            }
+                "timeout": ("INT", {"default": 0, "min": 0, "max": 3600}),
+                **SCHEDULING_INPUTS,
+                "max_size": ("INT", {"default": 0, "min": 0, "max": 8192, "step": 64}),
+                **OUTPUT_INPUTS,
+            },
         }
     
-    RETURN_TYPES = ("IMAGE",)
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        return inputs_fingerprint(kwargs)
+
+    RETURN_TYPES = ("IMAGE", "BFL_RESULT", "IMAGE", "STRING")
+    RETURN_NAMES = ("image", "result", "preview", "path")
     FUNCTION = "generate"
     CATEGORY = "BFL/Kontext"
+    BATCH_INPUTS = ("input_image",)
+
+    def build_request(self, **kwargs):
+        payload = {
+            "prompt": kwargs['prompt'],
+            "output_format": kwargs['output_format'],
+            "safety_tolerance": kwargs['safety_tolerance'],
+            "seed": kwargs['seed'] if kwargs['seed'] != -1 else None,
+            "prompt_upsampling": kwargs.get('prompt_upsampling', False),
+        }
+        
+        # Agregar campos opcionales solo si tienen valor
+        if kwargs.get('input_image') is not None:
+            payload['input_image'] = image_to_base64(kwargs['input_image'], endpoint=kwargs['model'], field='input_image')
+        
+        if kwargs.get('aspect_ratio') and kwargs['aspect_ratio'].strip():
+            payload['aspect_ratio'] = kwargs['aspect_ratio']
+        
+        return kwargs['model'], payload
 
     def generate(self, **kwargs):
         try:
-            config = BFLConfigLoader()
-            
-            payload = {
-                "prompt": kwargs['prompt'],
-                "output_format": kwargs['output_format'],
-                "safety_tolerance": kwargs['safety_tolerance'],
-                "seed": kwargs['seed'] if kwargs['seed'] != -1 else None,
-                "prompt_upsampling": kwargs.get('prompt_upsampling', False),
-            }
-            
-            # Agregar campos opcionales solo si tienen valor
-            if kwargs.get('input_image') is not None:
-                payload['input_image'] = image_to_base64(kwargs['input_image'])
-            
-            if kwargs.get('aspect_ratio') and kwargs['aspect_ratio'].strip():
-                payload['aspect_ratio'] = kwargs['aspect_ratio']
-            
-            response = requests.post(
-                url=f"https://api.us1.bfl.ai/v1/{kwargs['model']}",
-                headers={"x-key": config.get_api_key(kwargs['x_key']), "Content-Type": "application/json"},
-                json={k: v for k, v in payload.items() if v is not None},
-                timeout=30
-            )
-            
-            return (handle_api_response(response, kwargs['output_format'], kwargs['x_key']),)
+            results = execute_batch(self.build_request, kwargs, self.BATCH_INPUTS)
+            return node_outputs(results, kwargs)
         
         except Exception as e:
             print(f"BFL Flux Kontext Error: {str(e)}")
-            return (create_error_image(),)
+            return (create_error_image(), None, create_error_image(), "")
 
 class BFL_DepthControl:
     @classmethod
@@ -304,43 +373,57 @@ class BFL_DepthControl:
                 "preprocessed_image": ("IMAGE",),
                 "seed": ("INT", {"default": -1}),
                 "prompt_upsampling": ("BOOLEAN", {"default": False}),
-            }
+                "tiled": ("BOOLEAN", {"default": False}),
+                "tile_size": ("INT", {"default": 1024, "min": 256, "max": 2048, "step": 32}),
+                "tile_overlap": ("INT", {"default": 128, "min": 0, "max": 512}),
+                "timeout": ("INT", {"default": 0, "min": 0, "max": 3600}),
+                **SCHEDULING_INPUTS,
+                "max_size": ("INT", {"default": 0, "min": 0, "max": 8192, "step": 64}),
+                **OUTPUT_INPUTS,
+            },
         }
     
-    RETURN_TYPES = ("IMAGE",)
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        return inputs_fingerprint(kwargs)
+
+    RETURN_TYPES = ("IMAGE", "BFL_RESULT", "IMAGE", "STRING")
+    RETURN_NAMES = ("image", "result", "preview", "path")
     FUNCTION = "generate"
     CATEGORY = "BFL/ControlNet"
+    BATCH_INPUTS = ("control_image", "preprocessed_image")
+
+    def build_request(self, **kwargs):
+        endpoint = "flux-pro-1.0-depth"
+        payload = {
+            "prompt": kwargs['prompt'],
+            "control_image": image_to_base64(kwargs['control_image'], endpoint=endpoint, field='control_image'),
+            "steps": kwargs['steps'],
+            "guidance": kwargs['guidance'],
+            "output_format": kwargs['output_format'],
+            "safety_tolerance": kwargs['safety_tolerance'],
+            "seed": kwargs['seed'] if kwargs['seed'] != -1 else None,
+            "prompt_upsampling": kwargs.get('prompt_upsampling', False),
+        }
+        
+        if kwargs.get('preprocessed_image') is not None:
+            payload['preprocessed_image'] = image_to_base64(kwargs['preprocessed_image'], endpoint=endpoint, field='preprocessed_image')
+        
+        return endpoint, payload
 
     def generate(self, **kwargs):
         try:
-            config = BFLConfigLoader()
-            
-            payload = {
-                "prompt": kwargs['prompt'],
-                "control_image": image_to_base64(kwargs['control_image']),
-                "steps": kwargs['steps'],
-                "guidance": kwargs['guidance'],
-                "output_format": kwargs['output_format'],
-                "safety_tolerance": kwargs['safety_tolerance'],
-                "seed": kwargs['seed'] if kwargs['seed'] != -1 else None,
-                "prompt_upsampling": kwargs.get('prompt_upsampling', False),
-            }
-            
-            if kwargs.get('preprocessed_image'):
-                payload['preprocessed_image'] = image_to_base64(kwargs['preprocessed_image'])
-            
-            response = requests.post(
-                url="https://api.us1.bfl.ai/v1/flux-pro-1.0-depth",
-                headers={"x-key": config.get_api_key(kwargs['x_key']), "Content-Type": "application/json"},
-                json=payload,
-                timeout=30
-            )
-            
-            return (handle_api_response(response, kwargs['output_format'], kwargs['x_key']),)
+            if kwargs.get('tiled'):
+                results = collect_tasks([submit_tiled(
+                    self.build_request, kwargs, self.BATCH_INPUTS, kwargs['tile_size'], kwargs['tile_overlap']
+                )])
+            else:
+                results = execute_batch(self.build_request, kwargs, self.BATCH_INPUTS)
+            return node_outputs(results, kwargs)
         
         except Exception as e:
             print(f"BFL Depth Error: {str(e)}")
-            return (create_error_image(),)
+            return (create_error_image(), None, create_error_image(), "")
 
 class BFL_FluxUltra:
     @classmethod
@@ -358,45 +441,271 @@ class BFL_FluxUltra:
                 "prompt_upsampling": ("BOOLEAN", {"default": False}),
                 "raw": ("BOOLEAN", {"default": False}),
                 "image_prompt": ("IMAGE",),
+                "image_prompt_result": ("BFL_RESULT",),
                 "image_prompt_strength": ("FLOAT", {"default": 0.1, "min": 0.0, "max": 1.0}),
-            }
+                "timeout": ("INT", {"default": 0, "min": 0, "max": 3600}),
+                **SCHEDULING_INPUTS,
+                "max_size": ("INT", {"default": 0, "min": 0, "max": 8192, "step": 64}),
+                **OUTPUT_INPUTS,
+            },
         }
     
-    RETURN_TYPES = ("IMAGE",)
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        return inputs_fingerprint(kwargs)
+
+    RETURN_TYPES = ("IMAGE", "BFL_RESULT", "IMAGE", "STRING")
+    RETURN_NAMES = ("image", "result", "preview", "path")
     FUNCTION = "generate"
     CATEGORY = "BFL/Ultra"
+    BATCH_INPUTS = ("image_prompt",)
+
+    def build_request(self, **kwargs):
+        endpoint = "flux-pro-1.1-ultra"
+        payload = {
+            "prompt": kwargs['prompt'],
+            "aspect_ratio": kwargs['aspect_ratio'],
+            "output_format": kwargs['output_format'],
+            "safety_tolerance": kwargs['safety_tolerance'],
+            "seed": kwargs['seed'] if kwargs['seed'] != -1 else None,
+            "prompt_upsampling": kwargs.get('prompt_upsampling', False),
+            "raw": kwargs.get('raw', False),
+        }
+        
+        # Agregar image_prompt solo si se proporciona
+        if kwargs.get('image_prompt') is not None:
+            payload['image_prompt'] = image_to_base64(kwargs['image_prompt'], endpoint=endpoint, field='image_prompt')
+            payload['image_prompt_strength'] = kwargs.get('image_prompt_strength', 0.1)
+        
+        return endpoint, payload
 
     def generate(self, **kwargs):
         try:
-            config = BFLConfigLoader()
-            
-            payload = {
-                "prompt": kwargs['prompt'],
-                "aspect_ratio": kwargs['aspect_ratio'],
-                "output_format": kwargs['output_format'],
-                "safety_tolerance": kwargs['safety_tolerance'],
-                "seed": kwargs['seed'] if kwargs['seed'] != -1 else None,
-                "prompt_upsampling": kwargs.get('prompt_upsampling', False),
-                "raw": kwargs.get('raw', False),
-            }
-            
-            # Agregar image_prompt solo si se proporciona
-            if kwargs.get('image_prompt') is not None:
-                payload['image_prompt'] = image_to_base64(kwargs['image_prompt'])
-                payload['image_prompt_strength'] = kwargs.get('image_prompt_strength', 0.1)
-            
-            response = requests.post(
-                url="https://api.us1.bfl.ai/v1/flux-pro-1.1-ultra",
-                headers={"x-key": config.get_api_key(kwargs['x_key']), "Content-Type": "application/json"},
-                json={k: v for k, v in payload.items() if v is not None},
-                timeout=30
-            )
-            
-            return (handle_api_response(response, kwargs['output_format'], kwargs['x_key']),)
+            results = execute_batch(self.build_request, kwargs, self.BATCH_INPUTS)
+            return node_outputs(results, kwargs)
         
         except Exception as e:
             print(f"BFL Flux Ultra Error: {str(e)}")
-            return (create_error_image(),)
+            return (create_error_image(), None, create_error_image(), "")
+
+class BFLSubmitNode:
+    # Variante "Submit" de un nodo: devuelve un BFL_TASK justo después del POST
+    # para que todas las peticiones independientes del grafo estén en curso a la vez
+    RETURN_TYPES = ("BFL_TASK",)
+    RETURN_NAMES = ("task",)
+    FUNCTION = "submit"
+    CATEGORY = "BFL/Async"
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        # Las opciones de salida se eligen en BFL Collect
+        input_types = super().INPUT_TYPES()
+        input_types["optional"] = {
+            name: spec for name, spec in input_types["optional"].items() if name not in OUTPUT_INPUTS
+        }
+        return input_types
+
+    def submit(self, **kwargs):
+        if kwargs.get('tiled'):
+            return (submit_tiled(self.build_request, kwargs, self.BATCH_INPUTS, kwargs['tile_size'], kwargs['tile_overlap']),)
+        return (submit_batch(self.build_request, kwargs, self.BATCH_INPUTS),)
+
+class BFL_ImageGeneratorSubmit(BFLSubmitNode, BFL_ImageGenerator):
+    pass
+
+class BFL_InpaintingSubmit(BFLSubmitNode, BFL_Inpainting):
+    def submit(self, **kwargs):
+        if kwargs.get('crop_to_mask') and not kwargs.get('tiled'):
+            return (self.submit_regions(kwargs),)
+        return super().submit(**kwargs)
+
+class BFL_CannyControlSubmit(BFLSubmitNode, BFL_CannyControl):
+    pass
+
+class BFL_ImageExpanderSubmit(BFLSubmitNode, BFL_ImageExpander):
+    pass
+
+class BFL_FluxKontextSubmit(BFLSubmitNode, BFL_FluxKontext):
+    pass
+
+class BFL_DepthControlSubmit(BFLSubmitNode, BFL_DepthControl):
+    pass
+
+class BFL_FluxUltraSubmit(BFLSubmitNode, BFL_FluxUltra):
+    pass
+
+class BFL_Collect:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "task": ("BFL_TASK",),
+            },
+            "optional": {
+                "task_2": ("BFL_TASK",),
+                "task_3": ("BFL_TASK",),
+                "task_4": ("BFL_TASK",),
+                **OUTPUT_INPUTS,
+            },
+        }
+    
+    RETURN_TYPES = ("IMAGE", "BFL_RESULT", "IMAGE", "STRING")
+    RETURN_NAMES = ("image", "result", "preview", "path")
+    FUNCTION = "collect"
+    CATEGORY = "BFL/Async"
+
+    def collect(self, **kwargs):
+        try:
+            handles = [kwargs[name] for name in ("task", "task_2", "task_3", "task_4") if kwargs.get(name) is not None]
+            return node_outputs(collect_tasks(handles), kwargs)
+        
+        except Exception as e:
+            print(f"BFL Collect Error: {str(e)}")
+            return (create_error_image(), None, create_error_image(), "")
+
+def node_defaults(node_class):
+    # Valores por defecto de las entradas con widget de un nodo
+    defaults = {}
+    for section in ("required", "optional"):
+        for name, spec in node_class.INPUT_TYPES().get(section, {}).items():
+            options = spec[1] if len(spec) > 1 else {}
+            if isinstance(spec[0], list):
+                defaults[name] = options.get("default", spec[0][0])
+            elif "default" in options:
+                defaults[name] = options["default"]
+    return defaults
+
+class BFL_Sweep:
+    SWEEP_NODES = {
+        "BFL Image Generator": BFL_ImageGenerator,
+        "BFL Flux Ultra": BFL_FluxUltra,
+    }
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "node": (list(cls.SWEEP_NODES), {"default": "BFL Image Generator"}),
+                "prompt": ("STRING", {"multiline": True}),
+                "sweep": ("STRING", {"multiline": True, "default": "seed = 1..4\nguidance = 2.0..5.0:4"}),
+                "output_format": (["jpeg", "png"], {"default": "jpeg"}),
+                "x_key": ("STRING", {"default": ""}),
+            },
+            "optional": {
+                "base": ("STRING", {"multiline": True, "default": "{}"}),
+                "image_prompt": ("IMAGE",),
+                "max_concurrency": ("INT", {"default": 8, "min": 1, "max": 64}),
+                "timeout": ("INT", {"default": 0, "min": 0, "max": 3600}),
+                **SCHEDULING_INPUTS,
+                "max_size": ("INT", {"default": 0, "min": 0, "max": 8192, "step": 64}),
+                "preview_size": ("INT", {"default": 384, "min": 64, "max": 2048, "step": 64}),
+            },
+        }
+
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        try:
+            _, jobs = cls.jobs(kwargs)
+        except Exception:
+            return float("NaN")
+        return inputs_fingerprint(kwargs)
+
+    RETURN_TYPES = ("IMAGE", "IMAGE")
+    RETURN_NAMES = ("images", "contact_sheet")
+    FUNCTION = "sweep"
+    CATEGORY = "BFL/Utils"
+
+    @classmethod
+    def jobs(cls, kwargs):
+        # Configuración base (valores por defecto del nodo + JSON "base") combinada
+        # con cada punto de la matriz de parámetros
+        node_class = cls.SWEEP_NODES[kwargs['node']]
+        input_types = node_class.INPUT_TYPES()
+        known = set(input_types.get("required", {})) | set(input_types.get("optional", {}))
+
+        base = json.loads(kwargs.get('base') or "{}")
+        if not isinstance(base, dict):
+            raise Exception("base must be a JSON object")
+        # Cada trabajo de la matriz se paga: se limita el total, no solo la concurrencia
+        axes = parse_sweep(kwargs['sweep'], max_jobs=BFLConfigLoader().get_int('SWEEP', 'MAX_JOBS', 64))
+        for name in list(base) + [name for name, _ in axes]:
+            if name not in known:
+                raise Exception(f"Unknown parameter '{name}' for {kwargs['node']}")
+
+        fixed = dict(node_defaults(node_class), **base)
+        fixed.update({
+            "prompt": kwargs['prompt'],
+            "output_format": kwargs['output_format'],
+            "x_key": kwargs.get('x_key'),
+            "timeout": kwargs.get('timeout'),
+            "image_prompt": kwargs.get('image_prompt'),
+            "priority": kwargs.get('priority', 'auto'),
+            "owner": kwargs.get('owner', ''),
+        })
+        return axes, [dict(fixed, **job) for job in expand_sweep(axes)]
+
+    def sweep(self, **kwargs):
+        try:
+            axes, jobs = self.jobs(kwargs)
+            node = self.SWEEP_NODES[kwargs['node']]()
+            preview_size = kwargs.get('preview_size') or 384
+            futures = submit_frames(
+                node.build_request, jobs, kwargs['output_format'], kwargs.get('x_key'), kwargs.get('timeout'),
+                max_concurrency=kwargs.get('max_concurrency', 8), max_size=kwargs.get('max_size') or None
+            )
+
+            # Cada celda se muestra en el nodo en cuanto termina
+            progress = progress_bar(len(futures))
+            index_of = {future: index for index, future in enumerate(futures)}
+            cells = [None] * len(futures)
+            for finished, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                index = index_of[future]
+                try:
+                    cells[index] = future.result().preview(preview_size)
+                except Exception as e:
+                    cells[index] = e
+                print(f"BFL Sweep: {finished}/{len(futures)} jobs finished")
+                report_progress(progress, finished, len(futures), cells[index] if isinstance(cells[index], torch.Tensor) else None)
+
+            results = collect_futures(futures)
+            labels = [
+                "\n".join(f"{name}={job[name]}" for name, _ in axes) + (" (failed)" if isinstance(result, Exception) else "")
+                for job, result in zip(jobs, results)
+            ]
+            # La salida "images" se rellena siempre: ComfyUI la cachea aunque no esté conectada
+            images = stack_results(results)
+            columns = len(axes[0][1]) if len(axes) > 1 else math.ceil(math.sqrt(len(jobs)))
+            return (images, contact_sheet(stack_results(cells), labels, columns, max_cell=preview_size))
+        
+        except Exception as e:
+            print(f"BFL Sweep Error: {str(e)}")
+            return (create_error_image(), create_error_image())
+
+class BFL_Metrics:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "format": (["summary", "prometheus", "jsonl"], {"default": "summary"}),
+            }
+        }
+    
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        # Las métricas cambian con cada petición: ejecutar siempre
+        return float("NaN")
+
+    RETURN_TYPES = ("STRING",)
+    FUNCTION = "report"
+    CATEGORY = "BFL/Utils"
+
+    def report(self, **kwargs):
+        metrics = BFLMetrics()
+        if kwargs['format'] == "prometheus":
+            return (metrics.to_prometheus(),)
+        if kwargs['format'] == "jsonl":
+            return (metrics.to_json_lines(),)
+        return (json.dumps(metrics.summary(), indent=2),)
 
 NODE_CLASS_MAPPINGS = {
     "BFL Image Generator": BFL_ImageGenerator,
@@ -406,6 +715,16 @@ NODE_CLASS_MAPPINGS = {
     "BFL Flux Kontext": BFL_FluxKontext,
     "BFL Depth Control": BFL_DepthControl,
     "BFL Flux Ultra": BFL_FluxUltra,
+    "BFL Image Generator Submit": BFL_ImageGeneratorSubmit,
+    "BFL Inpainting Submit": BFL_InpaintingSubmit,
+    "BFL Canny Control Submit": BFL_CannyControlSubmit,
+    "BFL Image Expander Submit": BFL_ImageExpanderSubmit,
+    "BFL Flux Kontext Submit": BFL_FluxKontextSubmit,
+    "BFL Depth Control Submit": BFL_DepthControlSubmit,
+    "BFL Flux Ultra Submit": BFL_FluxUltraSubmit,
+    "BFL Collect": BFL_Collect,
+    "BFL Sweep": BFL_Sweep,
+    "BFL Metrics": BFL_Metrics,
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {
@@ -416,4 +735,14 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "BFL Flux Kontext": "BFL Flux Kontext (Pro/Max)",
     "BFL Depth Control": "BFL Depth Control (Pro 1.0)",
     "BFL Flux Ultra": "BFL Flux Ultra (Pro 1.1)",
+    "BFL Image Generator Submit": "BFL Submit: Image Generator (Pro 1.1/1.0)",
+    "BFL Inpainting Submit": "BFL Submit: Inpainting (Pro 1.0 Fill)",
+    "BFL Canny Control Submit": "BFL Submit: Canny Control (Pro 1.0)",
+    "BFL Image Expander Submit": "BFL Submit: Image Expander (Pro 1.0)",
+    "BFL Flux Kontext Submit": "BFL Submit: Flux Kontext (Pro/Max)",
+    "BFL Depth Control Submit": "BFL Submit: Depth Control (Pro 1.0)",
+    "BFL Flux Ultra Submit": "BFL Submit: Flux Ultra (Pro 1.1)",
+    "BFL Collect": "BFL Collect",
+    "BFL Sweep": "BFL Sweep (Grid)",
+    "BFL Metrics": "BFL Metrics",
 }
\ No newline at end of file
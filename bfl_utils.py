@@ -2,12 +2,33 @@ import os
 import base64
 import requests
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFile
 import io
 import torch
 import configparser
+import hashlib
+import sqlite3
+import uuid
+import json
 import time
+import email.utils
+import re
+import hmac
+import secrets
+import contextlib
+import threading
+import asyncio
+import concurrent.futures
+import heapq
+import collections
+import itertools
+import ipaddress
+import math
 from urllib.parse import urljoin
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
 
 class BFLConfigLoader:
     _instance = None
@@ -41,33 +62,2135 @@ class BFLConfigLoader:
         # Si no hay key en ningún lado, lanzar error
         raise ValueError("No se encontró una API key válida. Por favor, configure una API key en el nodo o en el archivo config.ini")
 
-def image_to_base64(image_tensor, format='PNG'):
-    image = Image.fromarray((image_tensor.numpy().squeeze() * 255).astype(np.uint8))
-    buffered = io.BytesIO()
-    image.save(buffered, format=format)
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+    def get_base_url(self):
+        base_url = self.get_value('API', 'BASE_URL', "https://api.us1.bfl.ai/v1/")
+        return base_url if base_url.endswith('/') else base_url + '/'
 
-def mask_to_base64(mask_tensor, format='PNG'):
-    mask_array = (mask_tensor.numpy().squeeze() * 255).astype(np.uint8)
-    mask_image = Image.fromarray(mask_array)
-    buffered = io.BytesIO()
-    mask_image.save(buffered, format=format)
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+    def get_value(self, section, option, fallback=None):
+        try:
+            return self.config.get(section, option, fallback=fallback)
+        except Exception:
+            return fallback
+
+    def get_int(self, section, option, fallback=None):
+        try:
+            return self.config.getint(section, option, fallback=fallback)
+        except ValueError:
+            return fallback
+
+    def get_float(self, section, option, fallback=None):
+        try:
+            return self.config.getfloat(section, option, fallback=fallback)
+        except ValueError:
+            return fallback
+
+    def get_bool(self, section, option, fallback=None):
+        try:
+            return self.config.getboolean(section, option, fallback=fallback)
+        except ValueError:
+            return fallback
+
+class BFLHttpClient:
+    # Cliente HTTP compartido por todo el proceso: mantiene conexiones keep-alive
+    # abiertas contra la API y contra el CDN de entrega de resultados
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance.setup()
+                    cls._instance = instance
+        return cls._instance
+
+    def setup(self):
+        config = BFLConfigLoader()
+        self.pool_size = config.get_int('HTTP', 'POOL_SIZE', 16)
+        self.download_pool_size = config.get_int('HTTP', 'DOWNLOAD_POOL_SIZE', self.pool_size)
+        self.connect_timeout = config.get_float('HTTP', 'CONNECT_TIMEOUT', 10.0)
+        self.read_timeout = config.get_float('HTTP', 'READ_TIMEOUT', 30.0)
+        self.max_retries = config.get_int('HTTP', 'MAX_RETRIES', 3)
+        self.backoff_factor = config.get_float('HTTP', 'BACKOFF_FACTOR', 0.5)
+
+        self.api_session = self._create_session(self.pool_size)
+        self.delivery_session = self._create_session(self.download_pool_size)
+
+    def _create_session(self, pool_size):
+        # Los POST no se reintentan en errores de lectura o de estado porque no son
+        # idempotentes; los errores de conexión sí, ya que la petición no llegó a enviarse
+        retry = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=self.max_retries,
+            status=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.api_session.post(url, **kwargs)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.api_session.get(url, **kwargs)
+
+    def download(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.delivery_session.get(url, **kwargs)
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+BYTES_BUCKETS = (16 * 1024, 64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+    def quantile(self, q):
+        # Aproximación por el límite superior del bucket que contiene el cuantil
+        if not self.count:
+            return None
+        target = q * self.count
+        for bound, total in self.cumulative():
+            if total >= target:
+                return bound
+        return float("inf")
+
+class JobSpan:
+    # Tiempos de las distintas fases de una petición (codificación, envío,
+    # cola, generación, descarga y decodificación)
+    def __init__(self, endpoint=None):
+        self.endpoint = endpoint
+        self.task_id = None
+        self.started = time.time()
+        self.stages = {}
+        self.values = {}
+        self.status = None
+        self.error = None
+        self.finished = False
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def finish(self, status, error=None):
+        if self.finished:
+            return
+        self.finished = True
+        self.status = status
+        self.error = str(error) if error is not None else None
+        BFLMetrics().record_job(self)
+
+    def to_dict(self):
+        return {
+            "timestamp": self.started,
+            "endpoint": self.endpoint,
+            "task_id": self.task_id,
+            "status": self.status,
+            "error": self.error,
+            "stages": {stage: round(seconds, 6) for stage, seconds in self.stages.items()},
+            **self.values,
+        }
+
+class BFLMetrics:
+    # Registro de métricas del proceso: histogramas por endpoint y fase, y los
+    # últimos trabajos completos para exportarlos como JSON lines
+    _instance = None
+    _lock = threading.Lock()
+
+    METRICS = {
+        "bfl_stage_seconds": ("histogram", SECONDS_BUCKETS, "Time spent per job stage"),
+        "bfl_job_seconds": ("histogram", SECONDS_BUCKETS, "End-to-end job time"),
+        "bfl_payload_bytes": ("histogram", BYTES_BUCKETS, "Encoded request payload size"),
+        "bfl_upload_saved_bytes_total": ("counter", None, "Estimated upload bytes saved by input downscaling and codec choice"),
+        "bfl_result_bytes": ("histogram", BYTES_BUCKETS, "Downloaded result size"),
+        "bfl_polls_per_job": ("histogram", COUNT_BUCKETS, "get_result calls per job"),
+        "bfl_jobs_total": ("counter", None, "Finished jobs by status"),
+        "bfl_encodes_total": ("counter", None, "Input images encoded, by codec and cache result"),
+        "bfl_queue_wait_seconds": ("histogram", SECONDS_BUCKETS, "Wait for an active task slot, by priority class"),
+        "bfl_preemptions_total": ("counter", None, "Queued jobs overtaken by a higher priority class"),
+    }
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance.setup()
+                    cls._instance = instance
+        return cls._instance
+
+    def setup(self):
+        config = BFLConfigLoader()
+        self.jsonl_file = config.get_value('METRICS', 'JSONL_FILE', None)
+        self.recent = collections.deque(maxlen=config.get_int('METRICS', 'HISTORY', 1000))
+        self.series = {}
+        self._series_lock = threading.Lock()
+
+    def observe(self, metric, value, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._series_lock:
+            if key not in self.series:
+                kind, buckets, _ = self.METRICS[metric]
+                self.series[key] = Histogram(buckets) if kind == "histogram" else 0
+            if isinstance(self.series[key], Histogram):
+                self.series[key].observe(value)
+            else:
+                self.series[key] += value
+
+    def record_job(self, span):
+        endpoint = span.endpoint or "unknown"
+        for stage, seconds in span.stages.items():
+            self.observe("bfl_stage_seconds", seconds, endpoint=endpoint, stage=stage)
+        if 'payload_bytes' in span.values:
+            self.observe("bfl_payload_bytes", span.values['payload_bytes'], endpoint=endpoint)
+        if span.values.get('upload_saved_bytes'):
+            self.observe("bfl_upload_saved_bytes_total", span.values['upload_saved_bytes'], endpoint=endpoint)
+        if 'result_bytes' in span.values:
+            self.observe("bfl_result_bytes", span.values['result_bytes'], endpoint=endpoint)
+        if 'polls' in span.values:
+            self.observe("bfl_polls_per_job", span.values['polls'], endpoint=endpoint)
+        self.observe("bfl_job_seconds", time.time() - span.started, endpoint=endpoint)
+        self.observe("bfl_jobs_total", 1, endpoint=endpoint, status=span.status)
+
+        record = span.to_dict()
+        self.recent.append(record)
+        if self.jsonl_file:
+            try:
+                with open(self.jsonl_file, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record) + "\n")
+            except OSError as e:
+                print(f"BFL metrics write failed: {str(e)}")
+
+    def to_json_lines(self):
+        return "".join(json.dumps(record) + "\n" for record in list(self.recent))
+
+    def summary(self):
+        with self._series_lock:
+            items = list(self.series.items())
+        result = {}
+        for (metric, labels), value in sorted(items, key=lambda item: (item[0][0], item[0][1])):
+            name = metric + "".join(f"/{v}" for _, v in labels)
+            if isinstance(value, Histogram):
+                result[name] = {
+                    "count": value.count,
+                    "mean": value.sum / value.count if value.count else None,
+                    "p50": value.quantile(0.5),
+                    "p95": value.quantile(0.95),
+                    "p99": value.quantile(0.99),
+                }
+            else:
+                result[name] = value
+        return result
+
+    def to_prometheus(self):
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in pairs) + "}"
+
+        with self._series_lock:
+            items = sorted(self.series.items(), key=lambda item: (item[0][0], item[0][1]))
+            snapshot = []
+            for key, value in items:
+                if isinstance(value, Histogram):
+                    value = (list(value.cumulative()), value.sum, value.count)
+                snapshot.append((key, value))
+
+        lines = []
+        described = set()
+        for (metric, labels), value in snapshot:
+            kind, _, description = self.METRICS[metric]
+            if metric not in described:
+                described.add(metric)
+                lines.append(f"# HELP {metric} {description}")
+                lines.append(f"# TYPE {metric} {kind}")
+            if kind == "histogram":
+                buckets, total, count = value
+                for bound, cumulative in buckets:
+                    lines.append(f"{metric}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{metric}_bucket{format_labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{metric}_sum{format_labels(labels)} {total}")
+                lines.append(f"{metric}_count{format_labels(labels)} {count}")
+            else:
+                lines.append(f"{metric}{format_labels(labels)} {value}")
+
+        # Estado actual del motor de polling y de los limitadores
+        if BFLPollingEngine._instance is not None:
+            lines.append("# HELP bfl_pending_tasks Tasks currently being polled")
+            lines.append("# TYPE bfl_pending_tasks gauge")
+            lines.append(f"bfl_pending_tasks {BFLPollingEngine._instance.pending_count()}")
+        if BFLSingleFlight._instance is not None:
+            lines.append("# HELP bfl_inflight_requests Distinct deterministic requests in flight")
+            lines.append("# TYPE bfl_inflight_requests gauge")
+            lines.append(f"bfl_inflight_requests {BFLSingleFlight._instance.pending_count()}")
+        if BFLRateGovernor._instance is not None:
+            governor_stats = BFLRateGovernor._instance.stats()
+            for name in ("queued", "active", "active_limit"):
+                lines.append(f"# TYPE bfl_governor_{name} gauge")
+                for key, stats in governor_stats.items():
+                    lines.append(f"bfl_governor_{name}{format_labels([('key', key)])} {stats[name]}")
+            lines.append("# TYPE bfl_governor_queued_by_priority gauge")
+            for key, stats in governor_stats.items():
+                for priority, queued in stats["queued_by_priority"].items():
+                    labels = format_labels([('key', key), ('priority', priority)])
+                    lines.append(f"bfl_governor_queued_by_priority{labels} {queued}")
+        if BFLKeyPool._instance is not None:
+            pool_stats = BFLKeyPool._instance.stats()
+            for name in ("inflight", "healthy"):
+                lines.append(f"# TYPE bfl_key_{name} gauge")
+                for key, stats in pool_stats.items():
+                    lines.append(f"bfl_key_{name}{format_labels([('key', key)])} {stats[name]}")
+        if BFLRegionRegistry._instance is not None:
+            region_stats = BFLRegionRegistry._instance.stats()
+            lines.append("# TYPE bfl_region_latency_seconds gauge")
+            for region, stats in region_stats.items():
+                if stats["latency"] is not None:
+                    lines.append(f"bfl_region_latency_seconds{format_labels([('region', region)])} {stats['latency']:.4f}")
+            lines.append("# TYPE bfl_region_healthy gauge")
+            for region, stats in region_stats.items():
+                lines.append(f"bfl_region_healthy{format_labels([('region', region)])} {stats['healthy']}")
+        return "\n".join(lines) + "\n"
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def register_server_routes():
+    # Rutas opcionales en el servidor aiohttp de ComfyUI; fuera de ComfyUI no hay servidor
+    try:
+        from server import PromptServer
+        from aiohttp import web
+    except ImportError:
+        return
+
+    routes = PromptServer.instance.routes
+
+    @routes.get("/bfl/metrics")
+    async def bfl_metrics(request):
+        return web.Response(text=BFLMetrics().to_prometheus(), content_type="text/plain")
+
+    @routes.get("/bfl/metrics.jsonl")
+    async def bfl_metrics_jsonl(request):
+        return web.Response(text=BFLMetrics().to_json_lines(), content_type="application/x-ndjson")
+
+    @routes.post("/bfl/webhook")
+    async def bfl_webhook(request):
+        receiver = BFLWebhookReceiver()
+        # Sin Content-Length, aiohttp ya limita el cuerpo a client_max_size
+        if request.content_length is not None and request.content_length > receiver.MAX_BODY_BYTES:
+            return web.Response(status=413)
+        return web.Response(status=receiver.handle(await request.read(), request.headers))
+
+# Prioridad y owner de los trabajos de un nodo para el reparto de la concurrencia
+SCHEDULING_INPUTS = {
+    "priority": (["auto", "interactive", "normal", "batch"], {"default": "auto"}),
+    "owner": ("STRING", {"default": ""}),
+}
+
+# Opciones de representación de las salidas, comunes a los nodos que devuelven imágenes
+OUTPUT_INPUTS = {
+    "output_dtype": (["float32", "float16"], {"default": "float32"}),
+    "preview_size": ("INT", {"default": 512, "min": 64, "max": 2048, "step": 64}),
+    "save_to_disk": ("BOOLEAN", {"default": False}),
+}
+OUTPUT_DTYPES = {"float32": torch.float32, "float16": torch.float16}
+
+class BFLImageEncoder:
+    # Codificación de las imágenes de entrada. El códec se elige por endpoint y
+    # campo ("png:1", "webp:4", "jpeg:95"; el número es el esfuerzo o la calidad)
+    # y los resultados se guardan en un LRU por contenido del tensor, de modo que
+    # una misma imagen de control o máscara se codifica una sola vez. Antes de
+    # codificar, las imágenes mayores que la resolución efectiva del endpoint se
+    # reducen, y si el resultado supera el presupuesto de subida se prueban
+    # códecs con pérdida cada vez más compactos
+    _instance = None
+    _lock = threading.Lock()
+
+    DEFAULT_CODECS = {
+        # Las imágenes de control solo guían la estructura: JPEG de alta calidad basta
+        "flux-pro-1.0-canny.control_image": "jpeg:95",
+        "flux-pro-1.0-canny.preprocessed_image": "jpeg:95",
+        "flux-pro-1.0-depth.control_image": "jpeg:95",
+        "flux-pro-1.0-depth.preprocessed_image": "jpeg:95",
+    }
+
+    # (megapíxeles efectivos, presupuesto de subida en MB) por endpoint y campo.
+    # Fill y Expand devuelven la imagen a la resolución de entrada, así que
+    # solo se limita su tamaño de subida
+    DEFAULT_LIMITS = {
+        "flux-pro-1.1.image_prompt": (1.0, 2.0),
+        "flux-pro.image_prompt": (1.0, 2.0),
+        "flux-pro-1.1-ultra.image_prompt": (1.0, 2.0),
+        "flux-pro-1.0-canny.control_image": (2.1, 4.0),
+        "flux-pro-1.0-canny.preprocessed_image": (2.1, 4.0),
+        "flux-pro-1.0-depth.control_image": (2.1, 4.0),
+        "flux-pro-1.0-depth.preprocessed_image": (2.1, 4.0),
+        "flux-kontext-pro.input_image": (2.1, 4.0),
+        "flux-kontext-max.input_image": (2.1, 4.0),
+    }
+
+    # Códecs que se prueban, en orden, cuando una imagen supera su presupuesto
+    BUDGET_CODECS = ("jpeg:95", "jpeg:90", "jpeg:85", "jpeg:75")
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance.setup()
+                    cls._instance = instance
+        return cls._instance
+
+    def setup(self):
+        config = BFLConfigLoader()
+        self.config = config
+        self.default_codec = config.get_value('ENCODING', 'DEFAULT', 'png:1')
+        self.mask_codec = config.get_value('ENCODING', 'MASK', 'png:1')
+        self.workers = max(1, config.get_int('ENCODING', 'WORKERS', 4))
+        self.max_bytes = int(config.get_float('ENCODING', 'CACHE_SIZE_MB', 256.0) * 1024 * 1024)
+        self.limits_enabled = config.get_bool('UPLOAD', 'ENABLED', True)
+        self.default_budget = config.get_float('UPLOAD', 'TARGET_MB', 16.0)
+        self._tracking = threading.local()
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self._entries_lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="bfl-encode"
+        )
+
+    def codec_for(self, endpoint=None, field=None, format=None):
+        # Prioridad: "<endpoint>.<campo>", luego "<endpoint>" en [ENCODING], luego
+        # los valores por defecto del nodo
+        if endpoint:
+            for option in (f"{endpoint}.{field}", endpoint):
+                codec = self.config.get_value('ENCODING', option)
+                if codec:
+                    return codec.strip().lower()
+            if f"{endpoint}.{field}" in self.DEFAULT_CODECS:
+                return self.DEFAULT_CODECS[f"{endpoint}.{field}"]
+        if format and format.upper() != 'PNG':
+            return format.lower()
+        # Las máscaras siempre sin pérdida salvo que se configure lo contrario
+        return (self.mask_codec if field == 'mask' else self.default_codec).strip().lower()
+
+    def limits_for(self, endpoint=None, field=None):
+        # Devuelve (píxeles máximos, bytes máximos en base64); None si no hay límite.
+        # En [UPLOAD]: "<endpoint>.<campo> = 2mp, 4mb" o "<endpoint> = ..."
+        if not self.limits_enabled:
+            return None, None
+        megapixels, budget_mb = None, self.default_budget
+        if endpoint:
+            megapixels, budget_mb = self.DEFAULT_LIMITS.get(f"{endpoint}.{field}", (None, budget_mb))
+            for option in (f"{endpoint}.{field}", endpoint):
+                value = self.config.get_value('UPLOAD', option)
+                if value:
+                    megapixels, budget_mb = self.parse_limits(value, megapixels, budget_mb)
+                    break
+        max_pixels = int(megapixels * 1e6) if megapixels else None
+        max_bytes = int(budget_mb * 1024 * 1024) if budget_mb else None
+        return max_pixels, max_bytes
+
+    @staticmethod
+    def parse_limits(value, megapixels=None, budget_mb=None):
+        for part in value.split(','):
+            part = part.strip().lower()
+            try:
+                if part.endswith('mp'):
+                    megapixels = float(part[:-2]) or None
+                elif part.endswith('mb'):
+                    budget_mb = float(part[:-2]) or None
+                elif part:
+                    print(f"BFL upload: unknown limit '{part}'")
+            except ValueError:
+                print(f"BFL upload: invalid limit '{part}'")
+        return megapixels, budget_mb
+
+    @contextlib.contextmanager
+    def tracking(self):
+        # Acumula los bytes subidos y ahorrados por las imágenes codificadas en este hilo
+        stats = {"bytes": 0, "saved": 0}
+        self._tracking.stats = stats
+        try:
+            yield stats
+        finally:
+            self._tracking.stats = None
+
+    def _track(self, encoded, saved):
+        stats = getattr(self._tracking, 'stats', None)
+        if stats is not None:
+            stats["bytes"] += len(encoded)
+            stats["saved"] += saved
+
+    def encode(self, tensor, codec, limits=(None, None)):
+        max_pixels, max_bytes = limits
+        array = tensor.detach().cpu().contiguous().numpy()
+        digest = hashlib.blake2b(array, digest_size=16)
+        digest.update(f"{array.shape}{array.dtype}{codec}{max_pixels}{max_bytes}".encode('utf-8'))
+        key = digest.hexdigest()
+
+        with self._entries_lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                entry = self.entries[key]
+            else:
+                entry = None
+        BFLMetrics().observe("bfl_encodes_total", 1, codec=codec, cache="hit" if entry else "miss")
+        if entry is None:
+            entry = self._encode_limited(tensor, codec, max_pixels, max_bytes)
+            with self._entries_lock:
+                if key not in self.entries:
+                    self.entries[key] = entry
+                    self.total_bytes += len(entry[0])
+                while self.total_bytes > self.max_bytes and self.entries:
+                    _, (old, _) = self.entries.popitem(last=False)
+                    self.total_bytes -= len(old)
+        encoded, saved = entry
+        self._track(encoded, saved)
+        return encoded
+
+    def _encode_limited(self, tensor, codec, max_pixels=None, max_bytes=None):
+        # Devuelve (base64, bytes ahorrados estimados). El ahorro por la reducción se
+        # estima escalando el tamaño codificado por la proporción de píxeles, para no
+        # tener que codificar también la imagen completa
+        height, width = tensor.shape[-3:-1] if tensor.dim() == 4 else tensor.shape[-2:]
+        resized = downscale_to_pixels(tensor, max_pixels)
+        new_height, new_width = resized.shape[-3:-1] if resized.dim() == 4 else resized.shape[-2:]
+        data = self._encode_array(resized, codec)
+        baseline = len(data) * (height * width) / (new_height * new_width)
+
+        final_codec = codec
+        if max_bytes and base64_length(len(data)) > max_bytes and resized.dim() == 4:
+            # Las máscaras nunca pasan a un códec con pérdida
+            for candidate in self.BUDGET_CODECS:
+                if candidate == codec:
+                    continue
+                attempt = self._encode_array(resized, candidate)
+                if len(attempt) < len(data):
+                    data, final_codec = attempt, candidate
+                if base64_length(len(data)) <= max_bytes:
+                    break
+            if base64_length(len(data)) > max_bytes:
+                print(f"BFL upload: input still {len(data) / 1048576:.1f} MB after {final_codec}, over the budget")
+
+        encoded = base64.b64encode(data).decode('utf-8')
+        saved = max(0, base64_length(int(baseline)) - len(encoded))
+        if saved:
+            size = f"{width}x{height} -> {new_width}x{new_height}" if resized is not tensor else f"{width}x{height}"
+            print(f"BFL upload: input {size} {final_codec}, {len(encoded) / 1048576:.1f} MB (saved ~{saved / 1048576:.1f} MB)")
+        return encoded, saved
+
+    def _encode_array(self, tensor, codec):
+        name, _, effort = codec.partition(':')
+        # Conversión a uint8 en torch sin pasar por un array float intermedio de numpy
+        array = tensor.detach().squeeze().mul(255).clamp_(0, 255).to(torch.uint8).cpu().numpy()
+        image = Image.fromarray(array)
+        buffered = io.BytesIO()
+        if name == 'png':
+            image.save(buffered, format='PNG', compress_level=int(effort or 1))
+        elif name == 'webp':
+            image.save(buffered, format='WEBP', lossless=True, method=int(effort or 4))
+        elif name in ('jpeg', 'jpg'):
+            image.save(buffered, format='JPEG', quality=int(effort or 95))
+        else:
+            raise Exception(f"Unsupported input codec: {codec}")
+        return buffered.getvalue()
+
+def base64_length(size):
+    return 4 * ((size + 2) // 3)
+
+def downscale_to_pixels(tensor, max_pixels=None):
+    # Reducción vectorizada (bicúbica con antialias) de una imagen [B, H, W, C] o
+    # máscara [B, H, W] a como mucho max_pixels, manteniendo la proporción
+    is_image = tensor.dim() == 4
+    height, width = tensor.shape[-3:-1] if is_image else tensor.shape[-2:]
+    if not max_pixels or height * width <= max_pixels:
+        return tensor
+    scale = math.sqrt(max_pixels / (height * width))
+    size = (max(1, int(height * scale)), max(1, int(width * scale)))
+    batch = tensor.movedim(-1, 1) if is_image else tensor.reshape(-1, 1, height, width)
+    batch = torch.nn.functional.interpolate(
+        batch.float(), size=size, mode='bicubic', antialias=True, align_corners=False
+    ).clamp_(0, 1)
+    return batch.movedim(1, -1) if is_image else batch[:, 0]
+
+def image_to_base64(image_tensor, format='PNG', endpoint=None, field=None):
+    if isinstance(image_tensor, BFLResult):
+        # Resultado de otro nodo BFL: se reenvían los bytes originales sin recodificar
+        return image_tensor.to_base64()
+    encoder = BFLImageEncoder()
+    return encoder.encode(image_tensor, encoder.codec_for(endpoint, field, format), encoder.limits_for(endpoint, field))
+
+def mask_to_base64(mask_tensor, format='PNG', endpoint=None, field='mask'):
+    encoder = BFLImageEncoder()
+    return encoder.encode(mask_tensor, encoder.codec_for(endpoint, field, format), encoder.limits_for(endpoint, field))
+
+def parse_retry_after(value):
+    # Retry-After puede venir en segundos o como fecha HTTP
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+PRIORITY_CLASSES = ("interactive", "normal", "batch")
+
+def resolve_priority(priority, jobs=1):
+    # "auto": interactivo si el nodo envía un solo trabajo y batch si envía varios
+    if priority in PRIORITY_CLASSES:
+        return priority
+    return "interactive" if jobs == 1 else "batch"
+
+class QueueTicket:
+    def __init__(self, priority, owner, start, finish):
+        self.priority = priority
+        self.owner = owner
+        self.start = start
+        self.finish = finish
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.cancelled = False
+
+class FairQueue:
+    # Cola de espera de los huecos de tarea activa: prioridad estricta entre clases
+    # y, dentro de cada clase, reparto justo ponderado (WFQ) entre owners. Un
+    # trabajo en cola aún no se ha enviado, así que uno de mayor prioridad
+    # simplemente pasa por delante
+    def __init__(self, weights=None):
+        self.weights = weights or {}
+        self.heaps = {priority: [] for priority in PRIORITY_CLASSES}
+        self.virtual_time = {priority: 0.0 for priority in PRIORITY_CLASSES}
+        self.last_finish = {}
+        self.counter = itertools.count()
+
+    def push(self, priority, owner):
+        start = max(self.virtual_time[priority], self.last_finish.get((priority, owner), 0.0))
+        finish = start + 1.0 / self.weights.get(owner, 1.0)
+        self.last_finish[(priority, owner)] = finish
+        ticket = QueueTicket(priority, owner, start, finish)
+        heapq.heappush(self.heaps[priority], (finish, next(self.counter), ticket))
+        return ticket
+
+    def head(self):
+        for priority in PRIORITY_CLASSES:
+            heap = self.heaps[priority]
+            while heap and heap[0][2].cancelled:
+                heapq.heappop(heap)
+            if heap:
+                return heap[0][2]
+        return None
+
+    def pop(self):
+        ticket = heapq.heappop(self.heaps[self.head().priority])[2]
+        self.virtual_time[ticket.priority] = ticket.start
+        return ticket
+
+    def waiting_behind(self, priority):
+        # Trabajos de clases inferiores que siguen esperando
+        lower = PRIORITY_CLASSES[PRIORITY_CLASSES.index(priority) + 1:]
+        return any(not entry[2].cancelled for name in lower for entry in self.heaps[name])
+
+    def counts(self):
+        return {
+            priority: sum(1 for entry in heap if not entry[2].cancelled)
+            for priority, heap in self.heaps.items()
+        }
+
+class KeyGovernor:
+    # Limitador de una API key: token bucket para los envíos y un máximo de tareas
+    # activas. Ante respuestas 429 reduce ambos límites y los recupera poco a poco.
+    # Los huecos libres se reparten con una FairQueue, y los trabajos que no son
+    # interactivos dejan libres interactive_reserve huecos
+    def __init__(self, rate, burst, max_active, max_retries, adaptive, interactive_reserve=0, owner_weights=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.max_active = max_active
+        self.limit = max_active
+        self.max_retries = max_retries
+        self.adaptive = adaptive
+        self.interactive_reserve = interactive_reserve
+        self.queue = FairQueue(owner_weights)
+        self.preempted = 0
+
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.active = 0
+        self.waiting = 0
+        self.submitted = 0
+        self.throttled = 0
+        self.successes = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, priority="normal", owner="default"):
+        with self.cond:
+            ticket = self.queue.push(priority, owner)
+            self.waiting += 1
+            try:
+                self._grant()
+                while not ticket.granted:
+                    self.cond.wait()
+            finally:
+                self.waiting -= 1
+                if not ticket.granted:
+                    ticket.cancelled = True
+        BFLMetrics().observe("bfl_queue_wait_seconds", time.monotonic() - ticket.enqueued, priority=priority)
+
+    def _capacity(self, priority):
+        if priority == "interactive":
+            return self.limit
+        return max(1, self.limit - self.interactive_reserve)
+
+    def _grant(self):
+        # Llamar con self.cond adquirido
+        granted = False
+        while True:
+            ticket = self.queue.head()
+            if ticket is None or self.active >= self._capacity(ticket.priority):
+                break
+            self.queue.pop()
+            if self.queue.waiting_behind(ticket.priority):
+                self.preempted += 1
+                BFLMetrics().observe("bfl_preemptions_total", 1, priority=ticket.priority)
+            ticket.granted = True
+            self.active += 1
+            granted = True
+        if granted:
+            self.cond.notify_all()
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self._grant()
+
+    def _take_token(self):
+        while True:
+            with self.cond:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def _record_success(self):
+        with self.cond:
+            self.submitted += 1
+            self.successes += 1
+            # Recuperación aditiva tras una racha de envíos sin 429
+            if self.adaptive and self.successes >= 10:
+                self.successes = 0
+                self.rate = min(self.max_rate, self.rate * 1.1)
+                if self.limit < self.max_active:
+                    self.limit += 1
+                    self._grant()
+
+    def _record_throttle(self, delay):
+        with self.cond:
+            self.throttled += 1
+            self.successes = 0
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            # Reducción multiplicativa de los límites
+            if self.adaptive:
+                self.rate = max(self.max_rate * 0.05, self.rate * 0.7)
+                self.limit = max(1, int(self.limit * 0.7))
+
+    def send(self, send_request, fail_over=None):
+        # fail_over() indica si hay otra key a la que pasar la petición: en ese caso
+        # el primer 429 se devuelve sin esperar ni reintentar con esta key
+        for attempt in range(self.max_retries + 1):
+            self._take_token()
+            response = send_request()
+            if response.status_code != 429:
+                self._record_success()
+                return response
+
+            delay = parse_retry_after(response.headers.get('Retry-After'))
+            if delay is None:
+                delay = min(2 ** attempt, 60)
+            self._record_throttle(delay)
+            if fail_over is not None and fail_over():
+                return response
+            if attempt < self.max_retries:
+                print(f"BFL rate limit exceeded, retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+        return response
+
+    def stats(self):
+        with self.cond:
+            return {
+                "queued": self.waiting,
+                "queued_by_priority": self.queue.counts(),
+                "preempted": self.preempted,
+                "active": self.active,
+                "active_limit": self.limit,
+                "submit_rate": round(self.rate, 3),
+                "submitted": self.submitted,
+                "throttled": self.throttled,
+            }
+
+class BFLRateGovernor:
+    # Registro de limitadores por API key compartido por todo el proceso
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance.setup()
+                    cls._instance = instance
+        return cls._instance
+
+    def setup(self):
+        config = BFLConfigLoader()
+        self.rate = config.get_float('RATE_LIMIT', 'SUBMITS_PER_SECOND', 2.0)
+        self.burst = config.get_int('RATE_LIMIT', 'BURST', 4)
+        self.max_active = config.get_int('RATE_LIMIT', 'MAX_ACTIVE_TASKS', 24)
+        self.max_retries = config.get_int('RATE_LIMIT', 'MAX_RETRIES', 5)
+        self.adaptive = config.get_bool('RATE_LIMIT', 'ADAPTIVE', True)
+        self.interactive_reserve = config.get_int('SCHEDULER', 'INTERACTIVE_RESERVE', 2)
+        self.owner_weights = {}
+        if config.config.has_section('OWNERS'):
+            for owner, weight in config.config.items('OWNERS'):
+                try:
+                    self.owner_weights[owner] = max(0.01, float(weight))
+                except ValueError:
+                    print(f"BFL scheduler: invalid weight '{weight}' for owner {owner}")
+        self.governors = {}
+        self._governors_lock = threading.Lock()
+
+    def for_key(self, api_key, max_active=None):
+        with self._governors_lock:
+            if api_key not in self.governors:
+                self.governors[api_key] = KeyGovernor(
+                    self.rate, self.burst, max_active or self.max_active, self.max_retries, self.adaptive,
+                    self.interactive_reserve, self.owner_weights
+                )
+            return self.governors[api_key]
+
+    def stats(self):
+        # Las keys se identifican solo por sus últimos caracteres
+        with self._governors_lock:
+            governors = list(self.governors.items())
+        return {f"...{api_key[-4:]}": governor.stats() for api_key, governor in governors}
+
+class BFLKeyPool:
+    # Conjunto de API keys de config.ini ([API] X_KEY y las de [KEYS]). Cada envío
+    # va a la key sana con menos tareas en curso en proporción a su peso, y una
+    # key que recibe 401/403/429 sale de la rotación durante un tiempo. Sin keys
+    # en config.ini se usa la key del nodo
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance.setup()
+                    cls._instance = instance
+        return cls._instance
+
+    def setup(self):
+        config = BFLConfigLoader()
+        self.auth_cooldown = config.get_float('KEY_POOL', 'AUTH_COOLDOWN', 600.0)
+        self.throttle_cooldown = config.get_float('KEY_POOL', 'THROTTLE_COOLDOWN', 30.0)
+        self.entries = collections.OrderedDict()
+        self.inflight = collections.Counter()
+        self.unhealthy_until = {}
+        self._pool_lock = threading.Lock()
+
+        config_key = config.get_value('API', 'X_KEY')
+        if config_key and config_key.strip():
+            self.entries[config_key.strip()] = {"name": "X_KEY", "weight": 1.0, "max_active": None}
+        if config.config.has_section('KEYS'):
+            for name, value in config.config.items('KEYS'):
+                entry = self.parse_entry(name, value)
+                if entry is not None:
+                    self.entries[entry.pop("key")] = entry
+
+    @staticmethod
+    def parse_entry(name, value):
+        # "<key>[, weight=2][, max_active=8]"
+        parts = [part.strip() for part in value.split(',')]
+        if not parts[0]:
+            return None
+        entry = {"key": parts[0], "name": name, "weight": 1.0, "max_active": None}
+        for part in parts[1:]:
+            option, _, setting = part.partition('=')
+            option = option.strip().lower()
+            try:
+                if option == 'weight':
+                    entry["weight"] = max(0.01, float(setting))
+                elif option == 'max_active':
+                    entry["max_active"] = max(1, int(setting))
+                else:
+                    print(f"BFL key pool: unknown option '{option}' for key {name}")
+            except ValueError:
+                print(f"BFL key pool: invalid value '{setting}' for {option} of key {name}")
+        return entry
+
+    def keys(self, node_api_key=None):
+        if self.entries:
+            return list(self.entries)
+        return [BFLConfigLoader().get_api_key(node_api_key)]
+
+    def max_active(self, api_key):
+        entry = self.entries.get(api_key)
+        return entry["max_active"] if entry else None
+
+    def acquire(self, node_api_key=None, exclude=()):
+        # Elige la key sana menos cargada (tareas en curso / peso). Si ninguna está
+        # sana se usa la que antes vuelva a estarlo
+        candidates = [key for key in self.keys(node_api_key) if key not in exclude]
+        if not candidates:
+            raise Exception("No API key left to try")
+        with self._pool_lock:
+            now = time.monotonic()
+            healthy = [key for key in candidates if self.unhealthy_until.get(key, 0) <= now]
+            if healthy:
+                api_key = min(healthy, key=lambda key: (self.inflight[key] / self.weight(key), -self.weight(key)))
+            else:
+                api_key = min(candidates, key=lambda key: self.unhealthy_until.get(key, 0))
+            self.inflight[api_key] += 1
+        return api_key
+
+    def release(self, api_key):
+        with self._pool_lock:
+            self.inflight[api_key] -= 1
+            if self.inflight[api_key] <= 0:
+                del self.inflight[api_key]
+
+    def weight(self, api_key):
+        entry = self.entries.get(api_key)
+        return entry["weight"] if entry else 1.0
+
+    def report(self, api_key, response):
+        # Saca la key de la rotación tras un 401/403 (credenciales) o un 429 (límite)
+        if response.status_code in (401, 403):
+            cooldown = self.auth_cooldown
+        elif response.status_code == 429:
+            cooldown = parse_retry_after(response.headers.get('Retry-After'))
+            if cooldown is None:
+                cooldown = self.throttle_cooldown
+        else:
+            return
+        with self._pool_lock:
+            self.unhealthy_until[api_key] = max(self.unhealthy_until.get(api_key, 0), time.monotonic() + cooldown)
+        print(f"BFL key pool: key {self.label(api_key)} out of rotation for {cooldown:.0f}s (HTTP {response.status_code})")
+
+    def healthy_alternatives(self, node_api_key=None, exclude=()):
+        now = time.monotonic()
+        with self._pool_lock:
+            return [
+                key for key in self.keys(node_api_key)
+                if key not in exclude and self.unhealthy_until.get(key, 0) <= now
+            ]
+
+    def key_for_hash(self, key_hash):
+        for api_key in self.entries:
+            if api_key_hash(api_key) == key_hash:
+                return api_key
+        return None
+
+    def label(self, api_key):
+        entry = self.entries.get(api_key)
+        return entry["name"] if entry else f"...{api_key[-4:]}"
+
+    def stats(self):
+        now = time.monotonic()
+        with self._pool_lock:
+            return {
+                self.label(api_key): {
+                    "weight": entry["weight"],
+                    "inflight": self.inflight[api_key],
+                    "healthy": int(self.unhealthy_until.get(api_key, 0) <= now),
+                }
+                for api_key, entry in self.entries.items()
+            }
+
+class BFLRegionRegistry:
+    # Regiones de la API ([REGIONS] en config.ini, o BASE_URL si no hay ninguna).
+    # Se mide la latencia de cada región y los envíos van a la región sana más
+    # rápida; una región que devuelve 5xx o no responde queda fuera durante
+    # FAILURE_COOLDOWN segundos y el envío pasa a la siguiente
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance.setup()
+                    cls._instance = instance
+        return cls._instance
+
+    def setup(self):
+        config = BFLConfigLoader()
+        self.failure_cooldown = config.get_float('ROUTING', 'FAILURE_COOLDOWN', 60.0)
+        self.smoothing = config.get_float('ROUTING', 'LATENCY_SMOOTHING', 0.2)
+        self.probe_interval = config.get_float('ROUTING', 'PROBE_INTERVAL', 300.0)
+        self.regions = collections.OrderedDict()
+        self._regions_lock = threading.Lock()
+
+        if config.config.has_section('REGIONS'):
+            for name, url in config.config.items('REGIONS'):
+                url = url.strip()
+                if url:
+                    self._add(name, url if url.endswith('/') else url + '/')
+        if not self.regions:
+            self._add('default', config.get_base_url())
+
+    def _add(self, name, base_url):
+        if any(region["url"] == base_url for region in self.regions.values()):
+            return
+        self.regions[name] = {
+            "url": base_url, "latency": None, "observed_at": 0.0,
+            "unhealthy_until": 0.0, "failures": 0,
+        }
+
+    def default_url(self):
+        return next(iter(self.regions.values()))["url"]
+
+    def ranked(self):
+        # Regiones sanas de la más rápida a la más lenta (las no medidas, o sin
+        # medir desde hace PROBE_INTERVAL, primero para sondearlas) y después las
+        # que están fuera por orden de recuperación
+        now = time.monotonic()
+        with self._regions_lock:
+            healthy = [name for name, region in self.regions.items() if region["unhealthy_until"] <= now]
+            unhealthy = [name for name in self.regions if name not in healthy]
+
+            def latency(name):
+                region = self.regions[name]
+                if region["latency"] is None or now - region["observed_at"] > self.probe_interval:
+                    return 0.0
+                return region["latency"]
+
+            healthy.sort(key=latency)
+            unhealthy.sort(key=lambda name: self.regions[name]["unhealthy_until"])
+            if healthy and latency(healthy[0]) == 0.0:
+                # Un solo sondeo por región a la vez
+                self.regions[healthy[0]]["observed_at"] = now
+        return healthy + unhealthy
+
+    def region_for_url(self, url):
+        for name, region in self.regions.items():
+            if url.startswith(region["url"]):
+                return name
+        return None
+
+    def observe(self, url, seconds=None, failed=False):
+        name = self.region_for_url(url)
+        if name is None:
+            return
+        with self._regions_lock:
+            region = self.regions[name]
+            region["observed_at"] = time.monotonic()
+            if failed:
+                region["failures"] += 1
+                region["unhealthy_until"] = time.monotonic() + self.failure_cooldown
+                print(f"BFL routing: region {name} out of rotation for {self.failure_cooldown:.0f}s")
+                return
+            if region["latency"] is None:
+                region["latency"] = seconds
+            else:
+                region["latency"] += self.smoothing * (seconds - region["latency"])
+
+    def post(self, endpoint, **kwargs):
+        # Envía a la mejor región y pasa a la siguiente ante un 5xx o un error de
+        # conexión. Un timeout de lectura no se reintenta en otra región porque la
+        # tarea puede haberse creado ya; solo se marca la región como caída
+        client = BFLHttpClient()
+        names = self.ranked()
+        for index, name in enumerate(names):
+            url = urljoin(self.regions[name]["url"], endpoint)
+            last = index == len(names) - 1
+            start = time.monotonic()
+            try:
+                response = client.post(url, **kwargs)
+            except requests.exceptions.ConnectionError:
+                self.observe(url, failed=True)
+                if last:
+                    raise
+                continue
+            except requests.exceptions.Timeout:
+                self.observe(url, failed=True)
+                raise
+            if response.status_code >= 500:
+                self.observe(url, failed=True)
+                if not last:
+                    print(f"BFL routing: HTTP {response.status_code} from region {name}, failing over")
+                    continue
+            else:
+                self.observe(url, time.monotonic() - start)
+            return response
+
+    def stats(self):
+        now = time.monotonic()
+        with self._regions_lock:
+            return {
+                name: {
+                    "latency": region["latency"],
+                    "healthy": int(region["unhealthy_until"] <= now),
+                    "failures": region["failures"],
+                }
+                for name, region in self.regions.items()
+            }
+
+def payload_hash(endpoint, payload):
+    # Hash canónico de la petición: las imágenes codificadas se sustituyen por su
+    # propio hash para no serializar megabytes de base64 en la clave
+    def canonical(value):
+        if isinstance(value, str) and len(value) > 1024:
+            return "sha256:" + hashlib.sha256(value.encode('utf-8')).hexdigest()
+        if isinstance(value, dict):
+            return {k: canonical(v) for k, v in value.items() if v is not None}
+        if isinstance(value, (list, tuple)):
+            return [canonical(v) for v in value]
+        return value
+
+    body = json.dumps([endpoint, canonical(payload)], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+def inputs_fingerprint(inputs):
+    # Huella de las entradas de un nodo para IS_CHANGED. También con seed = -1:
+    # ComfyUI solo vuelve a ejecutar (y pagar) el nodo si cambia alguna entrada
+    digest = hashlib.sha256()
+    for name in sorted(inputs):
+        value = inputs[name]
+        digest.update(name.encode('utf-8'))
+        if isinstance(value, torch.Tensor):
+            array = value.detach().cpu().contiguous().numpy()
+            digest.update(str(array.shape).encode('utf-8'))
+            digest.update(array.tobytes())
+        else:
+            digest.update(repr(value).encode('utf-8'))
+    return digest.hexdigest()
+
+class BFLResultCache:
+    # Caché en disco de resultados direccionada por contenido. Guarda los bytes
+    # originales devueltos por la API y expulsa las entradas menos usadas
+    # cuando se supera el tamaño máximo
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance.setup()
+                    cls._instance = instance
+        return cls._instance
+
+    def setup(self):
+        config = BFLConfigLoader()
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        self.enabled = config.get_bool('CACHE', 'ENABLED', False)
+        self.directory = config.get_value('CACHE', 'DIRECTORY', os.path.join(current_dir, "cache"))
+        self.max_bytes = int(config.get_float('CACHE', 'MAX_SIZE_MB', 1024.0) * 1024 * 1024)
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self._entries_lock = threading.Lock()
+
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+            self._load_index()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.img")
+
+    def _load_index(self):
+        # Reconstruir el orden LRU a partir de la fecha de último acceso de cada fichero
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.img'):
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            files.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total_bytes += size
+
+    def get(self, key, max_size=None):
+        if not self.enabled:
+            return None
+        with self._entries_lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._entries_lock:
+                size = self.entries.pop(key, 0)
+                self.total_bytes -= size
+            return None
+        return BFLResult(data=data, max_size=max_size)
+
+    def put(self, key, data):
+        if not self.enabled:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"BFL cache write failed: {str(e)}")
+            return
+
+        with self._entries_lock:
+            self.total_bytes -= self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            self.total_bytes += len(data)
+            evicted = []
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                old_key, size = self.entries.popitem(last=False)
+                self.total_bytes -= size
+                evicted.append(old_key)
+
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+def api_key_hash(api_key):
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+class BFLTaskJournal:
+    # Diario persistente (SQLite junto a config.ini) de las tareas enviadas. Si el
+    # proceso se reinicia con tareas en curso, se retoman en lugar de pagarlas de
+    # nuevo: al arrancar se vuelven a consultar y, si la misma petición se encola
+    # otra vez, el nodo se engancha a la tarea existente
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance.setup()
+                    cls._instance = instance
+        return cls._instance
+
+    def setup(self):
+        config = BFLConfigLoader()
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        self.enabled = config.get_bool('JOURNAL', 'ENABLED', True)
+        self.path = config.get_value('JOURNAL', 'PATH', os.path.join(current_dir, "tasks.sqlite"))
+        self.max_age = config.get_float('JOURNAL', 'MAX_AGE_MINUTES', 60.0) * 60
+        self.retention = config.get_float('JOURNAL', 'RETENTION_DAYS', 7.0) * 86400
+        self.session = uuid.uuid4().hex
+        self.orphans = {}
+        self._orphans_lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self.db = None
+
+        if not self.enabled:
+            return
+        try:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "task_id TEXT PRIMARY KEY, endpoint TEXT, payload_hash TEXT, key_hash TEXT, "
+                "output_format TEXT, deterministic INTEGER, status TEXT, session TEXT, "
+                "claimed INTEGER DEFAULT 0, created_at REAL, updated_at REAL, polling_url TEXT)"
+            )
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(tasks)")]
+            if 'polling_url' not in columns:
+                # Diarios creados antes de guardar la URL de polling
+                self.db.execute("ALTER TABLE tasks ADD COLUMN polling_url TEXT")
+            self.db.execute("CREATE INDEX IF NOT EXISTS tasks_request ON tasks (endpoint, payload_hash)")
+            self.db.execute("DELETE FROM tasks WHERE updated_at < ?", (time.time() - self.retention,))
+            self.db.commit()
+        except sqlite3.Error as e:
+            print(f"BFL task journal disabled: {str(e)}")
+            self.enabled = False
+            self.db = None
+
+    def _execute(self, query, params=()):
+        with self._db_lock:
+            try:
+                rows = self.db.execute(query, params).fetchall()
+                self.db.commit()
+                return rows
+            except sqlite3.Error as e:
+                print(f"BFL task journal error: {str(e)}")
+                return []
+
+    def record(self, task_id, endpoint, payload_key, api_key, output_format, deterministic, polling_url=None):
+        if not self.enabled:
+            return
+        now = time.time()
+        self._execute(
+            "INSERT OR REPLACE INTO tasks (task_id, endpoint, payload_hash, key_hash, output_format, "
+            "deterministic, status, session, claimed, created_at, updated_at, polling_url) "
+            "VALUES (?, ?, ?, ?, ?, ?, 'pending', ?, 0, ?, ?, ?)",
+            (task_id, endpoint, payload_key, api_key_hash(api_key), output_format,
+             int(deterministic), self.session, now, now, polling_url)
+        )
+
+    def mark_finished(self, task_id, future):
+        if not self.enabled:
+            return
+        status = 'failed' if future.cancelled() or future.exception() is not None else 'ready'
+        self._execute("UPDATE tasks SET status = ?, updated_at = ? WHERE task_id = ?", (status, time.time(), task_id))
+
+    def track(self, task_id, future):
+        future.add_done_callback(lambda f: self.mark_finished(task_id, f))
+
+    def _resume(self, row, api_key, timeout=None, lazy=False):
+        task_id, endpoint, payload_key, key_hash, output_format, deterministic, polling_url = row
+        cache_key = payload_key if deterministic and BFLResultCache().enabled else None
+        span = JobSpan(endpoint)
+        span.task_id = task_id
+        span.set('resumed', True)
+        future = BFLPollingEngine().submit(
+            task_id, output_format, api_key, endpoint, timeout, None, cache_key, span, lazy, polling_url
+        )
+        self.track(task_id, future)
+        return future
+
+    def _mark_claimed(self, task_id):
+        # La tarea pasa a esta sesión: ninguna otra petición puede engancharse a ella
+        self._execute("UPDATE tasks SET claimed = 1, session = ? WHERE task_id = ?", (self.session, task_id))
+
+    def resume_pending(self):
+        # Retomar las tareas deterministas sin terminar de sesiones anteriores cuya
+        # API key está en config.ini. Se descargan sin decodificar (solo bytes) y, si
+        # ningún nodo las reclama en MAX_AGE_MINUTES, se descartan
+        if not self.enabled:
+            return 0
+        pool = BFLKeyPool()
+
+        rows = self._execute(
+            "SELECT task_id, endpoint, payload_hash, key_hash, output_format, deterministic, polling_url FROM tasks "
+            "WHERE status = 'pending' AND claimed = 0 AND deterministic = 1 AND session != ? AND created_at > ?",
+            (self.session, time.time() - self.max_age)
+        )
+        resumed = 0
+        expires_at = time.monotonic() + self.max_age
+        for row in rows:
+            api_key = pool.key_for_hash(row[3])
+            if api_key is None:
+                continue
+            self._mark_claimed(row[0])
+            future = self._resume(row, api_key, lazy=True)
+            with self._orphans_lock:
+                self.orphans.setdefault((row[1], row[2], row[3]), []).append((expires_at, future))
+            resumed += 1
+        if resumed:
+            print(f"BFL task journal: resumed {resumed} unfinished task(s) from a previous session")
+            timer = threading.Timer(self.max_age, self._expire_orphans)
+            timer.daemon = True
+            timer.start()
+        return resumed
+
+    def _expire_orphans(self):
+        now = time.monotonic()
+        with self._orphans_lock:
+            for request_key in list(self.orphans):
+                alive = [entry for entry in self.orphans[request_key] if entry[0] > now]
+                if alive:
+                    self.orphans[request_key] = alive
+                else:
+                    del self.orphans[request_key]
+
+    def claim(self, endpoint, payload_key, api_keys, timeout=None):
+        # Cada tarea huérfana de una sesión anterior se entrega a una sola petición
+        # determinista (la misma regla que la clave de caché), sea cual sea la key
+        # del pool que la envió
+        if not self.enabled:
+            return None
+        self._expire_orphans()
+        key_hashes = {api_key_hash(api_key): api_key for api_key in api_keys}
+        with self._orphans_lock:
+            for key_hash in key_hashes:
+                request_key = (endpoint, payload_key, key_hash)
+                resumed = self.orphans.get(request_key, [])
+                while resumed:
+                    _, future = resumed.pop(0)
+                    if not resumed:
+                        del self.orphans[request_key]
+                    # Una tarea retomada que ya falló (URL caducada, tarea no
+                    # encontrada) no se entrega: la petición se enviará de nuevo
+                    if future.done() and (future.cancelled() or future.exception() is not None):
+                        continue
+                    return future
+
+        placeholders = ", ".join("?" for _ in key_hashes)
+        rows = self._execute(
+            "SELECT task_id, endpoint, payload_hash, key_hash, output_format, deterministic, polling_url FROM tasks "
+            f"WHERE endpoint = ? AND payload_hash = ? AND key_hash IN ({placeholders}) AND status = 'pending' "
+            "AND claimed = 0 AND deterministic = 1 AND session != ? AND created_at > ? ORDER BY created_at LIMIT 1",
+            (endpoint, payload_key, *key_hashes, self.session, time.time() - self.max_age)
+        )
+        if not rows:
+            return None
+        self._mark_claimed(rows[0][0])
+        print(f"BFL task journal: attaching to existing task {rows[0][0]}")
+        return self._resume(rows[0], key_hashes[rows[0][3]], timeout)
+
+def resume_pending_tasks():
+    try:
+        BFLTaskJournal().resume_pending()
+    except Exception as e:
+        print(f"BFL task journal: could not resume tasks: {str(e)}")
+
+def completed_future(result=None, error=None):
+    future = concurrent.futures.Future()
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+    return future
+
+def chain_future(source, target):
+    # Propaga el resultado de un future a otro
+    def propagate(future):
+        if target.done():
+            return
+        if future.cancelled():
+            target.cancel()
+        elif future.exception() is not None:
+            target.set_exception(future.exception())
+        else:
+            target.set_result(future.result())
+    source.add_done_callback(propagate)
+
+def fallback_future(source, fallback):
+    # Future con el resultado de source o, si source falla, con el del future que
+    # devuelve fallback(). fallback se llama en un hilo propio porque puede
+    # bloquear y source suele resolverse en el event loop del polling
+    target = concurrent.futures.Future()
+    def run_fallback():
+        try:
+            chain_future(fallback(), target)
+        except Exception as e:
+            target.set_exception(e)
+    def propagate(future):
+        if not future.cancelled() and future.exception() is None:
+            target.set_result(future.result())
+            return
+        threading.Thread(target=run_fallback, name="bfl-fallback", daemon=True).start()
+    source.add_done_callback(propagate)
+    return target
+
+def map_future(source, transform, executor=None):
+    # Future que se resuelve con transform(resultado) cuando termina source. Si
+    # transform hace trabajo de CPU debe pasarse un executor: el callback se ejecuta
+    # en el hilo que resuelve source, que suele ser el event loop del polling
+    target = concurrent.futures.Future()
+    def apply(result):
+        try:
+            target.set_result(transform(result))
+        except Exception as e:
+            target.set_exception(e)
+    def propagate(future):
+        if future.cancelled():
+            target.cancel()
+        elif future.exception() is not None:
+            target.set_exception(future.exception())
+        elif executor is None:
+            apply(future.result())
+        else:
+            try:
+                executor.submit(apply, future.result())
+            except RuntimeError as e:
+                target.set_exception(e)
+    source.add_done_callback(propagate)
+    return target
+
+class BFLSingleFlight:
+    # Peticiones idénticas en curso a la vez comparten una única tarea: la primera
+    # (líder) envía y el resto se engancha a su future y recibe el mismo tensor
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance.setup()
+                    cls._instance = instance
+        return cls._instance
+
+    def setup(self):
+        self.inflight = {}
+        self._inflight_lock = threading.Lock()
+
+    def join(self, key):
+        # Devuelve (future, es_líder)
+        with self._inflight_lock:
+            future = self.inflight.get(key)
+            if future is not None:
+                return future, False
+            future = concurrent.futures.Future()
+            self.inflight[key] = future
+        future.add_done_callback(lambda _: self._forget(key, future))
+        return future, True
+
+    def _forget(self, key, future):
+        with self._inflight_lock:
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
+
+    def pending_count(self):
+        with self._inflight_lock:
+            return len(self.inflight)
+
+def submit_task(endpoint, payload, output_format, node_api_key=None, timeout=None, max_size=None, span=None, lazy=False):
+    # Ruta común de todos los nodos: envía la petición y devuelve un Future que se
+    # resuelve con un BFLResult (decodificado salvo con lazy=True). Las peticiones
+    # deterministas se sirven antes desde la caché o se unen a una petición
+    # idéntica que ya esté en curso
+    payload = {k: v for k, v in payload.items() if v is not None}
+
+    span = span or JobSpan()
+    span.endpoint = endpoint
+    span.set('payload_bytes', sum(len(v) for v in payload.values() if isinstance(v, str)))
+
+    payload_key = payload_hash(endpoint, payload)
+    if payload.get('seed') is None:
+        return dispatch_task(endpoint, payload, payload_key, output_format, node_api_key, timeout, max_size, None, span, lazy)
+
+    try:
+        cache = BFLResultCache()
+        cache_key = payload_key if cache.enabled else None
+        if cache_key is not None:
+            cached = cache.get(cache_key, max_size=max_size)
+            if cached is not None:
+                print(f"BFL cache hit for {endpoint} ({cache_key[:12]})")
+                span.finish('cached')
+                return completed_future(cached)
+    except Exception as e:
+        span.finish('error', e)
+        raise
+
+    future, leader = BFLSingleFlight().join((payload_key, max_size))
+    if not leader:
+        print(f"BFL joining identical in-flight request for {endpoint} ({payload_key[:12]})")
+        span.finish('coalesced')
+        return future
 
-def handle_api_response(response, output_format, node_api_key=None):
+    try:
+        chain_future(
+            dispatch_task(endpoint, payload, payload_key, output_format, node_api_key, timeout, max_size, cache_key, span, lazy),
+            future
+        )
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    return future
+
+def dispatch_task(endpoint, payload, payload_key, output_format, node_api_key=None, timeout=None, max_size=None, cache_key=None, span=None, lazy=False, attach=True):
+    # Envía una petición nueva (o se engancha a una tarea del diario) y la entrega
+    # al motor de polling
+    span = span or JobSpan(endpoint)
+    deterministic = payload.get('seed') is not None
+
+    try:
+        pool = BFLKeyPool()
+        journal = BFLTaskJournal()
+        # Solo una petición con semilla fija puede reutilizar una tarea anterior
+        attached = None
+        if attach and deterministic:
+            attached = journal.claim(endpoint, payload_key, pool.keys(node_api_key), timeout)
+        if attached is not None:
+            span.finish('attached')
+            # Si la tarea retomada falla, la petición se envía como una nueva
+            def resubmit():
+                print(f"BFL task journal: resumed task for {endpoint} failed, submitting a new one")
+                retry_span = JobSpan(endpoint)
+                retry_span.values.update(span.values)
+                return dispatch_task(
+                    endpoint, payload, payload_key, output_format, node_api_key, timeout, max_size, cache_key,
+                    retry_span, lazy, attach=False
+                )
+            return fallback_future(attached, resubmit)
+
+        tried = []
+        while True:
+            api_key = pool.acquire(node_api_key, exclude=tried)
+            governor = BFLRateGovernor().for_key(api_key, pool.max_active(api_key))
+            with span.measure('throttle'):
+                governor.acquire(span.values.get('priority', 'normal'), span.values.get('owner', 'default'))
+            try:
+                with span.measure('submit'):
+                    response = governor.send(
+                        lambda: BFLRegionRegistry().post(
+                            endpoint,
+                            headers={"x-key": api_key, "Content-Type": "application/json"},
+                            json=dict(payload, **BFLWebhookReceiver().payload_fields())
+                        ),
+                        # Con otra key sana en el pool, un 429 pasa a ella en lugar de esperar
+                        fail_over=lambda: bool(pool.healthy_alternatives(node_api_key, exclude=tried + [api_key]))
+                    )
+                if response.status_code in (401, 403, 429):
+                    pool.report(api_key, response)
+                    tried.append(api_key)
+                    if pool.healthy_alternatives(node_api_key, exclude=tried):
+                        # Reintentar con otra key del pool
+                        governor.release()
+                        pool.release(api_key)
+                        continue
+                result = parse_submit_response(response)
+            except Exception:
+                governor.release()
+                pool.release(api_key)
+                raise
+            break
+    except Exception as e:
+        span.finish('error', e)
+        raise
+
+    span.task_id = result['id']
+    # La tarea se consulta en la URL que devuelve la API (puede estar en otro
+    # cluster) y siempre con la misma key que la envió
+    polling_url = result.get('polling_url') or urljoin(response.url, f"get_result?id={result['id']}")
+    journal.record(result['id'], endpoint, payload_key, api_key, output_format, deterministic, polling_url)
+    future = BFLPollingEngine().submit(
+        result['id'], output_format, api_key, endpoint, timeout, max_size, cache_key, span, lazy, polling_url
+    )
+    journal.track(result['id'], future)
+    # El hueco de tarea activa se libera cuando la tarea termina, no al enviarla
+    def release(_):
+        governor.release()
+        pool.release(api_key)
+    future.add_done_callback(release)
+    return future
+
+def build_frame_request(build_request, frame, jobs=1):
+    # La prioridad y el owner del trabajo viajan en su span hasta el limitador
+    span = JobSpan()
+    span.set('priority', resolve_priority(frame.get('priority'), jobs))
+    span.set('owner', frame.get('owner') or 'default')
+    with span.measure('encode'), BFLImageEncoder().tracking() as upload:
+        endpoint, payload = build_request(**frame)
+    if upload["saved"]:
+        span.set('upload_saved_bytes', upload["saved"])
+    return endpoint, payload, span
+
+def encode_frames(build_request, frames):
+    # Codifica los frames en el pool del codificador, como mucho WORKERS frames por
+    # delante del envío para no acumular payloads en memoria. Devuelve futures en orden
+    if len(frames) == 1:
+        try:
+            encoded = completed_future(build_frame_request(build_request, frames[0]))
+        except Exception as e:
+            encoded = completed_future(error=e)
+        yield encoded
+        return
+    encoder = BFLImageEncoder()
+    pending = collections.deque()
+    for frame in frames:
+        pending.append(encoder.executor.submit(build_frame_request, build_request, frame, len(frames)))
+        if len(pending) > encoder.workers:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+def split_batch(inputs, batch_inputs):
+    # Divide las entradas de imagen/máscara de un nodo en un juego de entradas por
+    # frame. Las entradas con un solo frame se reutilizan en todos los demás. Un
+    # BFL_RESULT conectado en "<nombre>_result" sustituye a la imagen "<nombre>"
+    inputs = dict(inputs)
+    sizes = {}
+    for name in batch_inputs:
+        if inputs.get(f"{name}_result") is not None:
+            inputs[name] = inputs[f"{name}_result"]
+        value = inputs.get(name)
+        if isinstance(value, torch.Tensor):
+            if value.dim() == 2:
+                value = value.unsqueeze(0)
+            sizes[name] = value.shape[0]
+        elif isinstance(value, list):
+            sizes[name] = len(value)
+
+    batch_size = max(sizes.values(), default=1)
+    for name, size in sizes.items():
+        if size not in (1, batch_size):
+            raise Exception(f"Batch size mismatch: '{name}' has {size} frames, expected 1 or {batch_size}")
+
+    frames = []
+    for index in range(batch_size):
+        frame = dict(inputs)
+        for name in sizes:
+            value = inputs[name]
+            if isinstance(value, list):
+                frame[name] = value[index if sizes[name] > 1 else 0]
+                continue
+            if value.dim() == 2:
+                value = value.unsqueeze(0)
+            frame[name] = value[index:index + 1] if sizes[name] > 1 else value
+        frames.append(frame)
+    return frames
+
+def stack_results(results, dtype=torch.float32):
+    # Apila los resultados en el orden de entrada. Los elementos fallidos se
+    # sustituyen por la imagen de error con el tamaño del resto del lote
+    results = [r.pixels() if isinstance(r, BFLResult) else r for r in results]
+    images = [r for r in results if isinstance(r, torch.Tensor)]
+    if not images:
+        raise Exception(f"All {len(results)} batch items failed: {str(results[0])}")
+
+    height, width = images[0].shape[1:3]
+    frames = []
+    for result in results:
+        if not isinstance(result, torch.Tensor):
+            result = create_error_image(width, height)
+        elif result.shape[1:3] != (height, width):
+            result = torch.nn.functional.interpolate(
+                promote_image(result).movedim(-1, 1), size=(height, width), mode='bilinear', align_corners=False
+            ).movedim(1, -1)
+        frames.append(result)
+
+    # Los píxeles uint8 se promueven directamente sobre el tensor de salida, sin
+    # una copia float32 intermedia por frame
+    stacked = torch.empty((sum(f.shape[0] for f in frames), height, width, 3), dtype=dtype)
+    offset = 0
+    for frame in frames:
+        target = stacked[offset:offset + frame.shape[0]]
+        target.copy_(frame)
+        if frame.dtype == torch.uint8:
+            target.div_(255.0)
+        offset += frame.shape[0]
+    return stacked
+
+def execute_batch(build_request, inputs, batch_inputs=(), lazy=False):
+    # Devuelve un BFLResult (o la excepción del frame fallido) por frame, en orden
+    frames = split_batch(inputs, batch_inputs)
+    output_format = inputs['output_format']
+    node_api_key = inputs.get('x_key')
+    timeout = inputs.get('timeout')
+    max_size = inputs.get('max_size') or None
+
+    if len(frames) == 1:
+        endpoint, payload, span = build_frame_request(build_request, frames[0])
+        return [submit_task(endpoint, payload, output_format, node_api_key, timeout, max_size, span, lazy).result()]
+
+    return collect_futures(submit_frames(
+        build_request, frames, output_format, node_api_key, timeout, lazy, max_size=max_size
+    ))
+
+def submit_frames(build_request, frames, output_format, node_api_key=None, timeout=None, lazy=False, max_concurrency=None, max_size=None):
+    # Cada frame se codifica y se envía mientras los anteriores siguen en curso,
+    # con un máximo de tareas simultáneas. Devuelve un future por frame, en orden
+    if max_concurrency is None:
+        max_concurrency = BFLConfigLoader().get_int('BATCH', 'MAX_CONCURRENCY', 4)
+    slots = threading.BoundedSemaphore(max(1, max_concurrency))
+    futures = []
+    for encoded in encode_frames(build_request, frames):
+        try:
+            endpoint, payload, span = encoded.result()
+        except Exception as e:
+            futures.append(completed_future(error=e))
+            continue
+
+        slots.acquire()
+        try:
+            future = submit_task(endpoint, payload, output_format, node_api_key, timeout, max_size, span, lazy)
+        except Exception as e:
+            slots.release()
+            future = completed_future(error=e)
+        else:
+            future.add_done_callback(lambda _: slots.release())
+        futures.append(future)
+    return futures
+
+def collect_futures(futures):
+    results = []
+    for index, future in enumerate(futures):
+        try:
+            results.append(future.result())
+        except Exception as e:
+            print(f"BFL batch item {index + 1}/{len(futures)} failed: {str(e)}")
+            results.append(e)
+    return results
+
+def node_outputs(results, inputs):
+    # Salidas (IMAGE, BFL_RESULT, preview, path) de un nodo. IMAGE y preview se
+    # rellenan siempre: ComfyUI cachea las salidas con la misma huella de entradas,
+    # sin importar qué salidas estaban conectadas. Los nodos BFL encadenados usan
+    # los bytes originales. Con save_to_disk el resultado se escribe en disco y el
+    # BFL_RESULT pasa a ser solo una referencia al fichero
+    if not any(isinstance(r, BFLResult) for r in results):
+        raise Exception(f"All {len(results)} batch items failed: {str(results[0])}")
+    dtype = OUTPUT_DTYPES.get(inputs.get('output_dtype'), torch.float32)
+
+    image = stack_results(results, dtype)
+    size = inputs.get('preview_size') or 512
+    preview = stack_results([r.preview(size) if isinstance(r, BFLResult) else r for r in results], dtype)
+
+    results = [r if isinstance(r, BFLResult) else BFLResult(error=r) for r in results]
+    if inputs.get('save_to_disk'):
+        directory = output_directory()
+        for result in results:
+            if result.error is None:
+                result.save(directory)
+    paths = "\n".join(result.path or "" for result in results)
+    return (image, results, preview, paths)
+
+def output_directory():
+    # Carpeta de salida de ComfyUI (subcarpeta "bfl"), o [OUTPUT] DIRECTORY
+    directory = BFLConfigLoader().get_value('OUTPUT', 'DIRECTORY')
+    if not directory:
+        try:
+            import folder_paths
+            directory = os.path.join(folder_paths.get_output_directory(), "bfl")
+        except ImportError:
+            directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "output")
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+def progress_bar(total):
+    # Barra de progreso del nodo que se está ejecutando en ComfyUI (None fuera de ComfyUI)
+    try:
+        import comfy.utils
+    except ImportError:
+        return None
+    return comfy.utils.ProgressBar(total)
+
+def report_progress(progress, value, total, image=None):
+    # Avanza la barra y, si se pasa una imagen, la muestra como vista previa del nodo
+    if progress is None:
+        return
+    preview = None
+    if image is not None:
+        array = (promote_image(image)[0, ..., :3].clamp(0, 1) * 255).round().to(torch.uint8).cpu().numpy()
+        preview = ("JPEG", Image.fromarray(array), max(array.shape[:2]))
+    progress.update_absolute(value, total, preview)
+
+class BFLTaskHandle:
+    # Referencia ligera a una o varias tareas ya enviadas (tipo BFL_TASK). Solo
+    # guarda los futures del motor de polling, no las imágenes de entrada
+    def __init__(self, endpoint, futures):
+        self.endpoint = endpoint
+        self.futures = futures
+
+    def __len__(self):
+        return len(self.futures)
+
+    def done(self):
+        return all(future.done() for future in self.futures)
+
+    def __repr__(self):
+        pending = sum(1 for future in self.futures if not future.done())
+        return f"BFLTaskHandle({self.endpoint}, {len(self.futures)} tasks, {pending} pending)"
+
+def submit_batch(build_request, inputs, batch_inputs=()):
+    # Igual que execute_batch pero sin esperar: devuelve el handle justo después
+    # de los POST, y los errores de envío quedan registrados en cada future
+    output_format = inputs['output_format']
+    node_api_key = inputs.get('x_key')
+    timeout = inputs.get('timeout')
+    max_size = inputs.get('max_size') or None
+
+    endpoint = None
+    futures = []
+    for encoded in encode_frames(build_request, split_batch(inputs, batch_inputs)):
+        try:
+            endpoint, payload, span = encoded.result()
+            futures.append(submit_task(endpoint, payload, output_format, node_api_key, timeout, max_size, span, lazy=True))
+        except Exception as e:
+            futures.append(completed_future(error=e))
+    return BFLTaskHandle(endpoint, futures)
+
+def mask_bounding_box(mask, padding=64, multiple=32, min_size=256):
+    # Recuadro (x0, y0, x1, y1) alrededor de la zona enmascarada con margen de
+    # contexto, ajustado a múltiplos de "multiple" y a un tamaño mínimo. Sin
+    # máscara se devuelve la imagen completa
+    height, width = mask.shape[-2:]
+    covered = mask.reshape(-1, height, width)[0] > 0.5
+    rows = torch.nonzero(covered.any(dim=1)).flatten()
+    cols = torch.nonzero(covered.any(dim=0)).flatten()
+    if rows.numel() == 0:
+        return 0, 0, width, height
+
+    def fit(start, end, limit):
+        start, end = max(0, start - padding), min(limit, end + padding)
+        size = max(end - start, min_size)
+        size = min(limit, -(-size // multiple) * multiple)
+        start = min(max(0, (start + end) // 2 - size // 2), limit - size)
+        return start, start + size
+
+    y0, y1 = fit(int(rows[0]), int(rows[-1]) + 1, height)
+    x0, x1 = fit(int(cols[0]), int(cols[-1]) + 1, width)
+    return x0, y0, x1, y1
+
+def composite_patch(image, mask, box, patch, feather=16):
+    # Funde el parche generado con la imagen original usando la máscara dilatada y
+    # suavizada (feather) como peso, de modo que no quedan bordes visibles
+    x0, y0, x1, y1 = box
+    height, width = y1 - y0, x1 - x0
+    if patch.shape[1:3] != (height, width):
+        patch = torch.nn.functional.interpolate(
+            patch.movedim(-1, 1), size=(height, width), mode='bilinear', align_corners=False
+        ).movedim(1, -1)
+
+    weight = mask.reshape(1, 1, *mask.shape[-2:])[:, :, y0:y1, x0:x1].float()
+    if feather > 0:
+        kernel = 2 * feather + 1
+        weight = torch.nn.functional.max_pool2d(weight, kernel, stride=1, padding=feather)
+        weight = torch.nn.functional.avg_pool2d(weight, kernel, stride=1, padding=feather, count_include_pad=False)
+    weight = weight.movedim(1, -1)
+
+    result = image.clone()
+    region = result[:, y0:y1, x0:x1]
+    result[:, y0:y1, x0:x1] = region + (patch.to(region.dtype) - region) * weight
+    return result
+
+def submit_masked_regions(build_request, inputs, padding=64, feather=16):
+    # Inpainting por regiones: de cada frame solo se envía el recorte alrededor de
+    # la máscara y el parche devuelto se funde con la imagen original
+    crops = []
+    masks = []
+    regions = []
+    for frame in split_batch(inputs, ("image", "mask")):
+        image = frame.get('image')
+        if image is None:
+            raise Exception("An image or image_result input is required")
+        if isinstance(image, BFLResult):
+            image = image.tensor()
+        mask = frame['mask'].reshape(1, *frame['mask'].shape[-2:])
+        if mask.shape[-2:] != image.shape[1:3]:
+            mask = torch.nn.functional.interpolate(
+                mask.unsqueeze(1), size=image.shape[1:3], mode='bilinear', align_corners=False
+            ).squeeze(1)
+
+        # El margen debe dejar sitio a la transición del feather dentro del recorte
+        x0, y0, x1, y1 = box = mask_bounding_box(mask, padding=max(padding, 2 * feather))
+        crops.append(image[:, y0:y1, x0:x1])
+        masks.append(mask[:, y0:y1, x0:x1])
+        regions.append((image, mask, box))
+
+    handle = submit_batch(build_request, dict(inputs, image=crops, mask=masks, image_result=None), ("image", "mask"))
+    # La decodificación del parche y la composición se hacen en el pool del
+    # codificador, no en el hilo del motor de polling
+    futures = [
+        map_future(future, lambda result, region=region: BFLResult(
+            image=composite_patch(*region, result.tensor(), feather=feather)
+        ), BFLImageEncoder().executor)
+        for future, region in zip(handle.futures, regions)
+    ]
+    return BFLTaskHandle(handle.endpoint, futures)
+
+def tile_starts(length, tile_size, overlap):
+    # Posiciones de inicio de los tiles a lo largo de un eje, repartidas para
+    # que cubran toda la longitud con al menos "overlap" píxeles de solape
+    if length <= tile_size:
+        return [0]
+    count = -(-(length - overlap) // (tile_size - overlap))
+    stride = (length - tile_size) / (count - 1)
+    return [round(index * stride) for index in range(count)]
+
+def tile_weight(box, height, width, overlap):
+    # Peso de fundido de un tile: rampa lineal en los bordes que se solapan con
+    # otro tile y peso 1 en los bordes de la imagen
+    x0, y0, x1, y1 = box
+
+    def ramp(start, end, limit):
+        weight = torch.ones(end - start)
+        if overlap > 0:
+            edge = (torch.arange(1, end - start + 1, dtype=torch.float32) / (overlap + 1)).clamp_(max=1.0)
+            if start > 0:
+                weight = torch.minimum(weight, edge)
+            if end < limit:
+                weight = torch.minimum(weight, edge.flip(0))
+        return weight
+
+    return (ramp(y0, y1, height)[:, None] * ramp(x0, x1, width)[None, :]).reshape(1, y1 - y0, x1 - x0, 1)
+
+def match_size(value, size):
+    # Redimensiona una imagen (B, H, W, C) o máscara (B, H, W) al tamaño dado
+    if value.shape[1:3] == tuple(size):
+        return value
+    if value.dim() == 3:
+        return torch.nn.functional.interpolate(
+            value.unsqueeze(1), size=size, mode='bilinear', align_corners=False
+        ).squeeze(1)
+    return torch.nn.functional.interpolate(
+        value.movedim(-1, 1), size=size, mode='bilinear', align_corners=False
+    ).movedim(1, -1)
+
+class TileAssembler:
+    # Reconstruye un frame a partir de sus tiles a medida que van llegando: solo
+    # se guardan el lienzo acumulado y la suma de pesos, nunca todos los tiles
+    def __init__(self, height, width, overlap):
+        self.height = height
+        self.width = width
+        self.overlap = overlap
+        self.canvas = torch.zeros(1, height, width, 3)
+        self.weights = torch.zeros(1, height, width, 1)
+        self.pending = 0
+        self.future = concurrent.futures.Future()
+        self._canvas_lock = threading.Lock()
+
+    def add(self, box, tile):
+        x0, y0, x1, y1 = box
+        tile = match_size(tile[..., :3], (y1 - y0, x1 - x0))
+        weight = tile_weight(box, self.height, self.width, self.overlap)
+        with self._canvas_lock:
+            self.canvas[:, y0:y1, x0:x1] += tile * weight
+            self.weights[:, y0:y1, x0:x1] += weight
+
+    def expect(self, count):
+        self.pending = count
+        if count == 0:
+            self._complete()
+
+    def add_result(self, box, future):
+        try:
+            self.add(box, future.result().tensor())
+        except Exception as e:
+            if not self.future.done():
+                self.future.set_exception(e)
+            return
+        with self._canvas_lock:
+            self.pending -= 1
+            finished = self.pending == 0
+        if finished:
+            self._complete()
+
+    def _complete(self):
+        if self.future.done():
+            return
+        self.canvas /= self.weights.clamp_(min=1e-6)
+        self.future.set_result(BFLResult(image=self.canvas))
+
+def submit_tiled(build_request, inputs, batch_inputs, tile_size=1024, overlap=128):
+    # Modo por tiles para imágenes mayores que el límite de la API: cada frame se
+    # divide en tiles solapados (junto con su máscara o mapa de control), todos se
+    # envían a la vez y se funden con pesos que ocultan las costuras. Con máscara,
+    # los tiles que no tocan la zona enmascarada no se envían
+    primary = batch_inputs[0]
+    overlap = max(0, min(overlap, tile_size // 2))
+    endpoint = None
+    futures = []
+    for frame in split_batch(inputs, batch_inputs):
+        tensors = {}
+        for name in batch_inputs:
+            value = frame.get(name)
+            if isinstance(value, BFLResult):
+                value = value.tensor()
+            if value is not None:
+                tensors[name] = value
+        if primary not in tensors:
+            raise Exception(f"A {primary} input is required for tiled mode")
+
+        height, width = tensors[primary].shape[1:3]
+        tensors = {name: match_size(value, (height, width)) for name, value in tensors.items()}
+        assembler = TileAssembler(height, width, overlap)
+
+        boxes = []
+        tiles = {name: [] for name in tensors}
+        for y in tile_starts(height, tile_size, overlap):
+            for x in tile_starts(width, tile_size, overlap):
+                box = (x, y, min(width, x + tile_size), min(height, y + tile_size))
+                crops = {name: value[:, box[1]:box[3], box[0]:box[2]] for name, value in tensors.items()}
+                if 'mask' in crops and not bool((crops['mask'] > 0.5).any()):
+                    assembler.add(box, crops[primary])
+                    continue
+                boxes.append(box)
+                for name, crop in crops.items():
+                    tiles[name].append(crop)
+
+        assembler.expect(len(boxes))
+        tile_inputs = dict(inputs, **tiles, **{f"{name}_result": None for name in batch_inputs})
+        handle = submit_batch(build_request, tile_inputs, tuple(tiles))
+        endpoint = handle.endpoint or endpoint
+        # Cada tile se decodifica y se funde en el pool del codificador, no en el
+        # hilo del motor de polling que resuelve su future
+        executor = BFLImageEncoder().executor
+        for box, future in zip(boxes, handle.futures):
+            future.add_done_callback(
+                lambda done, box=box, assembler=assembler: executor.submit(assembler.add_result, box, done)
+            )
+        futures.append(assembler.future)
+    return BFLTaskHandle(endpoint, futures)
+
+def collect_tasks(handles):
+    # Las tareas de los nodos Submit se descargan sin decodificar (lazy)
+    return collect_futures([future for handle in handles for future in handle.futures])
+
+def parse_submit_response(response):
     # Manejar diferentes códigos de estado HTTP
     if response.status_code == 200:
         try:
             result = response.json()
-            
-            if 'id' not in result:
-                raise Exception("Invalid API response format: missing task ID")
-            
-            return poll_task_result(result['id'], output_format, node_api_key=node_api_key)
-            
         except ValueError as e:
             raise Exception(f"Invalid JSON response from API: {str(e)}")
-    
+
+        if 'id' not in result:
+            raise Exception("Invalid API response format: missing task ID")
+
+        return result
+
     elif response.status_code == 422:
         try:
             error_data = response.json()
@@ -101,103 +2224,903 @@ def handle_api_response(response, output_format, node_api_key=None):
         
         raise Exception(f"API Error {response.status_code}: {error_msg}")
 
-def poll_task_result(task_id, output_format, max_attempts=10, node_api_key=None):
+def fetch_task_status(task_id, api_key=None, polling_url=None):
+    # Sin polling_url (tareas antiguas del diario) se consulta la región por defecto
     config = BFLConfigLoader()
-    base_url = "https://api.us1.bfl.ai/v1/"
-    
-    for attempt in range(max_attempts):
+    regions = BFLRegionRegistry()
+    url = polling_url or urljoin(regions.default_url(), f"get_result?id={task_id}")
+
+    start = time.monotonic()
+    try:
+        response = BFLHttpClient().get(url, headers={"x-key": api_key or config.get_api_key()})
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        regions.observe(url, failed=True)
+        raise
+    regions.observe(url, time.monotonic() - start, failed=response.status_code >= 500)
+
+    # Manejar errores HTTP
+    if response.status_code == 422:
+        error_data = response.json()
+        raise Exception(f"Validation Error: {error_data.get('detail', 'Unknown validation error')}")
+
+    response.raise_for_status()
+    return response.json()
+
+def parse_task_status(task_id, data):
+    # Devuelve la URL del resultado si la tarea terminó, o None si sigue en curso
+    if 'status' not in data:
+        raise Exception("Invalid API response: missing status field")
+
+    status = data['status']
+
+    # Manejar diferentes estados según la documentación
+    if status == 'Ready':
+        if 'result' not in data or not data['result'] or 'sample' not in data['result']:
+            raise Exception("Task completed but no result available")
+        return data['result']['sample']
+
+    elif status == 'Error':
+        error_msg = "Task failed"
+        if 'details' in data and data['details']:
+            error_msg = f"Task failed: {data['details']}"
+        raise Exception(error_msg)
+
+    elif status == 'Task not found':
+        raise Exception(f"Task not found: {task_id}")
+
+    elif status == 'Request Moderated':
+        raise Exception("Request was moderated by content filters")
+
+    elif status == 'Content Moderated':
+        raise Exception("Generated content was moderated by safety filters")
+
+    elif status != 'Pending':
+        # Estado desconocido, se sigue haciendo polling
+        print(f"Unknown status '{status}' for task {task_id}, retrying...")
+
+    return None
+
+def image_to_tensor(img, keep_alpha=False, dtype=torch.float32):
+    # Manejo explícito de canales: IMAGE en ComfyUI es siempre RGB y el alfa,
+    # si se pide, se devuelve aparte como MASK (1 = zona transparente)
+    alpha = None
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        if keep_alpha:
+            alpha = np.asarray(img.getchannel('A'), dtype=np.float32)
+            alpha /= -255.0
+            alpha += 1.0
+            alpha = torch.from_numpy(alpha)
+        img = img.convert('RGB')
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    if dtype == torch.uint8:
+        # Representación compacta (4 bytes menos por píxel y canal que float32)
+        tensor = torch.from_numpy(np.array(img, dtype=np.uint8)).unsqueeze(0)
+    else:
+        # Convertir directamente de los bytes de PIL a float32 y normalizar en el
+        # sitio, sin arrays intermedios
+        array = np.asarray(img, dtype=np.float32)
+        array /= 255.0
+        tensor = torch.from_numpy(array).unsqueeze(0).to(dtype)
+    if keep_alpha:
+        return tensor, alpha
+    return tensor
+
+def reduce_image(img, max_size):
+    if not max_size or max(img.size) <= max_size:
+        return img
+    scale = max_size / max(img.size)
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    # Con JPEG el decodificador puede escalar directamente a 1/2, 1/4 u 1/8
+    img.draft('RGB', size)
+    if img.size != size:
+        img = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+    return img
+
+def decode_image(data, max_size=None, keep_alpha=False, dtype=torch.float32):
+    img = Image.open(io.BytesIO(data))
+    return image_to_tensor(reduce_image(img, max_size), keep_alpha=keep_alpha, dtype=dtype)
+
+def promote_image(image, dtype=torch.float32):
+    # Pasa una imagen uint8 al rango 0-1 en el tipo pedido
+    if image.dtype == torch.uint8:
+        return image.to(dtype).div_(255.0)
+    return image.to(dtype)
+
+class StreamingDecoder:
+    # Alimenta el decodificador de PIL a medida que llegan los datos de la descarga
+    def __init__(self, span=None):
+        self.span = span or JobSpan()
+        self.reset()
+
+    def reset(self):
+        # La descarga volvió a empezar desde el principio
+        self.parser = ImageFile.Parser()
+
+    def feed(self, chunk):
+        with self.span.measure('decode'):
+            self.parser.feed(chunk)
+
+    def close(self, dtype=torch.float32):
+        with self.span.measure('decode'):
+            return image_to_tensor(self.parser.close(), dtype=dtype)
+
+class BFLDownloader:
+    # Descarga de resultados con memoria acotada: el cuerpo se escribe por trozos en
+    # un único buffer del tamaño anunciado (sin lista de trozos ni copia final) y se
+    # entrega a la vez al decodificador. El buffer no se reutiliza entre descargas:
+    # pasa a ser los bytes del BFLResult (caché, disco, nodos encadenados), y
+    # reutilizarlo obligaría a copiarlo. Tiene timeouts de conexión, lectura y total,
+    # un tamaño máximo, reanudación con Range tras un corte, comprobación de la
+    # longitud recibida y su propio pool de hilos, de modo que las descargas de las
+    # tareas terminadas no ocupan los hilos del polling
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance.setup()
+                    cls._instance = instance
+        return cls._instance
+
+    def setup(self):
+        config = BFLConfigLoader()
+        http = BFLHttpClient()
+        self.workers = max(1, config.get_int('DOWNLOAD', 'WORKERS', http.download_pool_size))
+        self.max_bytes = int(config.get_float('DOWNLOAD', 'MAX_MB', 64.0) * 1024 * 1024)
+        self.retries = config.get_int('DOWNLOAD', 'RETRIES', 3)
+        self.total_timeout = config.get_float('DOWNLOAD', 'TOTAL_TIMEOUT', 120.0)
+        self.chunk_size = config.get_int('DOWNLOAD', 'CHUNK_KB', 64) * 1024
+        self.timeout = (
+            config.get_float('DOWNLOAD', 'CONNECT_TIMEOUT', http.connect_timeout),
+            config.get_float('DOWNLOAD', 'READ_TIMEOUT', http.read_timeout),
+        )
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="bfl-download"
+        )
+
+    def _check_size(self, size):
+        if size > self.max_bytes:
+            raise Exception(f"Result is larger than the download limit ({size} > {self.max_bytes} bytes)")
+
+    def fetch(self, url, sink=None, span=None):
+        # Devuelve el cuerpo completo (bytearray). sink recibe cada trozo con feed()
+        # y reset() si la descarga tiene que empezar de nuevo
+        deadline = time.monotonic() + self.total_timeout
+        buffer = bytearray()
+        received = 0
+        total = None
+        last_error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                if time.monotonic() >= deadline:
+                    break
+                time.sleep(min(0.5 * 2 ** (attempt - 1), 8.0))
+            headers = {"Range": f"bytes={received}-"} if received else {}
+            try:
+                with BFLHttpClient().download(url, stream=True, timeout=self.timeout, headers=headers) as response:
+                    if received and response.status_code == 206 and parse_content_range(response) == received:
+                        if span is not None:
+                            span.set('download_resumes', span.values.get('download_resumes', 0) + 1)
+                    elif response.status_code == 206:
+                        # Un rango que no empieza donde se cortó la descarga (o que no se
+                        # pidió) no completa el cuerpo: volver a pedirlo entero
+                        last_error = Exception(f"unexpected range {response.headers.get('Content-Range')} at {received} bytes")
+                        received = 0
+                        if sink is not None:
+                            sink.reset()
+                        continue
+                    else:
+                        response.raise_for_status()
+                        if received:
+                            # El servidor no admite rangos: empezar desde cero
+                            received = 0
+                            if sink is not None:
+                                sink.reset()
+                        length = response.headers.get('Content-Length')
+                        total = int(length) if length and length.isdigit() else None
+                        if total is not None:
+                            self._check_size(total)
+                        buffer = bytearray(total if total is not None else self.chunk_size)
+
+                    for chunk in iter_arrived(response, self.chunk_size):
+                        end = received + len(chunk)
+                        self._check_size(end)
+                        if end > len(buffer):
+                            buffer.extend(bytes(max(end - len(buffer), len(buffer))))
+                        buffer[received:end] = chunk
+                        received = end
+                        if sink is not None:
+                            sink.feed(chunk)
+                        if time.monotonic() > deadline:
+                            raise Exception(f"Download timed out after {self.total_timeout:.0f}s ({received} bytes)")
+
+                if total is not None and received != total:
+                    # Conexión cortada antes de tiempo: reanudar donde se quedó
+                    last_error = Exception(f"incomplete body ({received}/{total} bytes)")
+                    continue
+                del buffer[received:]
+                return buffer
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError, urllib3.exceptions.HTTPError) as e:
+                last_error = e
+                print(f"BFL download interrupted at {received} bytes ({attempt + 1}/{self.retries + 1}): {str(e)}")
+        raise Exception(f"Download failed after {received} bytes: {str(last_error)}")
+
+def iter_arrived(response, chunk_size):
+    # Trozos del cuerpo a medida que llegan (como mucho chunk_size bytes). A
+    # diferencia de iter_content, no espera a completar cada trozo, así que tras un
+    # corte la descarga se reanuda desde el último byte recibido y no desde el
+    # último trozo completo
+    raw = response.raw
+    if not hasattr(raw, 'read1'):
+        yield from response.iter_content(chunk_size=chunk_size)
+        return
+    while True:
+        chunk = raw.read1(chunk_size, decode_content=True)
+        if not chunk:
+            return
+        yield chunk
+
+def parse_content_range(response):
+    # Primer byte de una respuesta 206 ("bytes 1000-1999/2000")
+    match = re.match(r"bytes (\d+)-", response.headers.get('Content-Range', ''))
+    return int(match.group(1)) if match else None
+
+def download_result(sample_url, max_size=None, cache_key=None, span=None, lazy=False):
+    # Devuelve un BFLResult con los bytes originales. Con lazy=True la imagen no se
+    # decodifica hasta que algún nodo la necesite. Sin max_size la imagen se
+    # decodifica mientras llega; la decodificación reducida necesita la cabecera
+    # antes de empezar, así que en ese caso se decodifica al terminar
+    span = span or JobSpan()
+    start = time.perf_counter()
+    decoder = StreamingDecoder(span) if not lazy and not max_size else None
+    image = None
+    try:
+        data = BFLDownloader().fetch(sample_url, decoder, span)
+        span.set('result_bytes', len(data))
+        if decoder is not None:
+            image = decoder.close(dtype=torch.uint8)
+        elif not lazy:
+            with span.measure('decode'):
+                image = decode_image(data, max_size=max_size, dtype=torch.uint8)
+    finally:
+        # La decodificación en streaming se solapa con la descarga: se descuenta
+        span.add('download', time.perf_counter() - start - span.stages.get('decode', 0.0))
+
+    if cache_key is not None:
+        BFLResultCache().put(cache_key, data)
+    return BFLResult(sample_url=sample_url, data=data, image=image, max_size=max_size)
+
+class BFLResult:
+    # Resultado de una tarea (tipo BFL_RESULT): URL firmada del resultado y bytes
+    # originales (o el fichero donde se guardaron), con la imagen decodificada bajo
+    # demanda y una sola vez. Los píxeles se guardan como uint8 y se promueven a
+    # float solo al entregarlos
+    def __init__(self, sample_url=None, data=None, image=None, max_size=None, error=None):
+        self.sample_url = sample_url
+        self.data = data
+        self.image = image
+        self.max_size = max_size
+        self.error = error
+        self.path = None
+        self._digest = None
+        self._decode_lock = threading.Lock()
+
+    def pixels(self):
+        # Imagen en su representación guardada (uint8 si se decodificó de los bytes)
+        if self.error is not None:
+            raise self.error
+        with self._decode_lock:
+            if self.image is None:
+                self.image = decode_image(self.bytes(), max_size=self.max_size, dtype=torch.uint8)
+            return self.image
+
+    def tensor(self, dtype=torch.float32):
+        return promote_image(self.pixels(), dtype)
+
+    def preview(self, size):
+        # Versión reducida, decodificada a tamaño reducido sin pasar por la imagen completa
+        if self.error is not None:
+            raise self.error
+        data = self.bytes()
+        if data is None:
+            image = promote_image(self.image)
+            scale = size / max(image.shape[1:3])
+            if scale >= 1:
+                return image
+            return torch.nn.functional.interpolate(
+                image.movedim(-1, 1), scale_factor=scale, mode='area'
+            ).movedim(1, -1)
+        return decode_image(data, max_size=size, dtype=torch.uint8)
+
+    def bytes(self):
+        if self.error is not None:
+            raise self.error
+        if self.data is None and self.path:
+            with open(self.path, 'rb') as f:
+                return f.read()
+        if self.data is None and self.sample_url:
+            self.data = BFLDownloader().fetch(self.sample_url)
+        return self.data
+
+    def save(self, directory):
+        # Escribe los bytes originales (nombre por contenido) y libera la memoria:
+        # a partir de aquí el resultado es solo una referencia al fichero
+        if self.path is None:
+            data = self.bytes()
+            if data is None:
+                data = encode_image_bytes(self.tensor())
+            self.path = os.path.join(directory, f"bfl_{self.digest()}.{image_extension(data)}")
+            if not os.path.exists(self.path):
+                temp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, self.path)
+        with self._decode_lock:
+            self.data = None
+            self.image = None
+        return self.path
+
+    def to_base64(self):
+        data = self.bytes()
+        if data is None:
+            return image_to_base64(self.tensor())
+        return base64.b64encode(data).decode('utf-8')
+
+    def digest(self):
+        # Huella del contenido (bytes originales o píxeles). Sin contenido en memoria
+        # se usa la URL o el error, sin guardarla, para no fijar una huella que no
+        # dependa del contenido
+        if self._digest is None:
+            if self.data is not None:
+                self._digest = hashlib.sha256(self.data).hexdigest()[:16]
+            elif self.image is not None:
+                self._digest = hashlib.sha256(self.image.cpu().numpy().tobytes()).hexdigest()[:16]
+            else:
+                return self.sample_url or repr(self.error)
+        return self._digest
+
+    def __repr__(self):
+        # Repr estable para IS_CHANGED: el mismo contenido da la misma huella
+        return f"BFLResult({self.digest()})"
+
+def image_extension(data):
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return "bin"
+
+def encode_image_bytes(image):
+    # PNG de una imagen sin bytes originales (composiciones de tiles o recortes)
+    array = (image[0].clamp(0, 1) * 255).round().to(torch.uint8).cpu().numpy()
+    buffer = io.BytesIO()
+    Image.fromarray(array).save(buffer, format='PNG', compress_level=1)
+    return buffer.getvalue()
+
+def public_host(host):
+    # Indica si un host de LISTEN es alcanzable desde fuera: un nombre DNS o una IP
+    # pública, nunca loopback, red privada ni una dirección comodín
+    host = host.strip('[]')
+    try:
+        return ipaddress.ip_address(host).is_global
+    except ValueError:
+        return host not in ('', 'localhost')
+
+class BFLWebhookReceiver:
+    # Modo webhook: cada envío incluye webhook_url y webhook_secret, y la API avisa
+    # al terminar la tarea. El aviso llega por la ruta /bfl/webhook del servidor de
+    # ComfyUI o por un listener local propio ([WEBHOOK] LISTEN), se verifica con
+    # HMAC-SHA256 del cuerpo y despierta la tarea en el motor de polling, que solo
+    # consulta get_result cada FALLBACK_INTERVAL segundos por si se pierde un aviso
+    _instance = None
+    _lock = threading.Lock()
+    # Un aviso es un JSON pequeño; cualquier cuerpo mayor se rechaza sin leerlo
+    MAX_BODY_BYTES = 64 * 1024
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance.setup()
+                    cls._instance = instance
+        return cls._instance
+
+    def setup(self):
+        config = BFLConfigLoader()
+        self.enabled = config.get_bool('WEBHOOK', 'ENABLED', False)
+        self.url = config.get_value('WEBHOOK', 'URL')
+        self.secret = config.get_value('WEBHOOK', 'SECRET') or secrets.token_hex(32)
+        self.listen = config.get_value('WEBHOOK', 'LISTEN')
+        self.signature_header = config.get_value('WEBHOOK', 'SIGNATURE_HEADER', 'X-BFL-Signature')
+        self.fallback_interval = config.get_float('WEBHOOK', 'FALLBACK_INTERVAL', 30.0)
+        self.received = 0
+        self.rejected = 0
+        self.server = None
+
+        if not self.enabled:
+            return
+        if not self.url and not (self.listen and public_host(self.listen.rpartition(':')[0])):
+            # La URL solo se deduce de LISTEN si es una dirección que la API puede
+            # alcanzar; con loopback, red privada o comodín hace falta la URL pública
+            print("BFL webhook: [WEBHOOK] URL with a public address is required, falling back to polling")
+            self.enabled = False
+            return
+        if self.listen:
+            self._start_listener()
+        if not self.url:
+            host = self.listen.rpartition(':')[0]
+            self.url = f"http://{host}:{self.server.server_address[1]}/bfl/webhook"
+        print(f"BFL webhook: completion callbacks enabled at {self.url}")
+
+    def _start_listener(self):
+        host, _, port = self.listen.rpartition(':')
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                # El cuerpo se lee antes de poder comprobar la firma: se limita su tamaño
+                length = self.headers.get('Content-Length', '0')
+                if not length.isdigit():
+                    status = 400
+                elif int(length) > receiver.MAX_BODY_BYTES:
+                    status = 413
+                else:
+                    status = receiver.handle(self.rfile.read(int(length)), self.headers)
+                if status in (400, 413):
+                    self.close_connection = True
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        self.server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="bfl-webhook", daemon=True).start()
+
+    def payload_fields(self):
+        if not self.enabled:
+            return {}
+        return {"webhook_url": self.url, "webhook_secret": self.secret}
+
+    @staticmethod
+    def sign(secret, body):
+        return "sha256=" + hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+
+    def handle(self, body, headers):
+        # Devuelve el código HTTP de la respuesta al aviso
+        if not self.enabled:
+            return 404
+        signature = headers.get(self.signature_header)
+        if not signature or not hmac.compare_digest(self.sign(self.secret, body), signature):
+            self.rejected += 1
+            return 401
         try:
-            response = requests.get(
-                urljoin(base_url, f"get_result?id={task_id}"),
-                headers={"x-key": config.get_api_key(node_api_key)},
-                timeout=30
-            )
-            
-            # Manejar errores HTTP
-            if response.status_code == 422:
-                error_data = response.json()
-                raise Exception(f"Validation Error: {error_data.get('detail', 'Unknown validation error')}")
-            
-            response.raise_for_status()
-            data = response.json()
-            
-            # Verificar que tenemos los campos requeridos
-            if 'status' not in data:
-                raise Exception("Invalid API response: missing status field")
-            
-            status = data['status']
-            
-            # Manejar diferentes estados según la documentación
-            if status == 'Ready':
-                if 'result' not in data or not data['result'] or 'sample' not in data['result']:
-                    raise Exception("Task completed but no result available")
-                
-                img_response = requests.get(data['result']['sample'])
-                img_response.raise_for_status()
-                img = Image.open(io.BytesIO(img_response.content))
-                
-                with io.BytesIO() as buffer:
-                    img.save(buffer, format=output_format.upper())
-                    buffer.seek(0)
-                    img_array = np.array(Image.open(buffer)).astype(np.float32) / 255.0
-                    return torch.from_numpy(img_array)[None,]
-            
-            elif status == 'Error':
-                error_msg = "Task failed"
-                if 'details' in data and data['details']:
-                    error_msg = f"Task failed: {data['details']}"
-                raise Exception(error_msg)
-            
-            elif status == 'Task not found':
-                raise Exception(f"Task not found: {task_id}")
-            
-            elif status == 'Request Moderated':
-                raise Exception("Request was moderated by content filters")
-            
-            elif status == 'Content Moderated':
-                raise Exception("Generated content was moderated by safety filters")
-            
-            elif status == 'Pending':
-                # Tarea en progreso, continuar polling
-                progress = data.get('progress', 0)
-                print(f"Task {task_id} in progress: {progress}% (attempt {attempt + 1}/{max_attempts})")
-                
-                # Tiempo de espera más razonable: máximo 60 segundos por intento
-                wait_time = min(2 ** attempt + 5, 60)
-                time.sleep(wait_time)
-                continue
-            
+            data = json.loads(body)
+        except ValueError:
+            return 400
+        task_id = data.get('id') or data.get('task_id') if isinstance(data, dict) else None
+        if not task_id:
+            return 400
+        self.received += 1
+        BFLPollingEngine().notify(task_id, data)
+        return 200
+
+class PollScheduler:
+    # Decide cuándo volver a consultar cada tarea a partir del progreso que informa
+    # la API y del historial de duraciones observadas por endpoint, siempre dentro
+    # del plazo total de la tarea
+    def __init__(self):
+        config = BFLConfigLoader()
+        self.initial_delay = config.get_float('POLLING', 'INITIAL_DELAY', 1.0)
+        self.min_interval = config.get_float('POLLING', 'MIN_INTERVAL', 0.5)
+        self.max_interval = config.get_float('POLLING', 'MAX_INTERVAL', 10.0)
+        self.default_timeout = config.get_float('POLLING', 'TIMEOUT', 600.0)
+        self.max_errors = config.get_int('POLLING', 'MAX_CONSECUTIVE_ERRORS', 5)
+        self.history_size = config.get_int('POLLING', 'HISTORY_SIZE', 20)
+        self.history = {}
+        self._lock = threading.Lock()
+
+    def record_completion(self, endpoint, duration):
+        if endpoint is None:
+            return
+        with self._lock:
+            history = self.history.setdefault(endpoint, collections.deque(maxlen=self.history_size))
+            history.append(duration)
+
+    def expected_duration(self, endpoint):
+        with self._lock:
+            history = self.history.get(endpoint)
+            if not history:
+                return None
+            durations = sorted(history)
+        return durations[len(durations) // 2]
+
+    def timeout_for(self, timeout=None):
+        return timeout if timeout and timeout > 0 else self.default_timeout
+
+    def first_delay(self, endpoint):
+        expected = self.expected_duration(endpoint)
+        if expected is None:
+            return self.initial_delay
+        # Primera consulta algo antes de la duración típica del endpoint
+        return self._clamp(expected * 0.8)
+
+    def next_delay(self, task, progress, now):
+        elapsed = now - task.started_at
+        remaining = None
+
+        if progress is not None and 0 < progress < 100:
+            remaining = elapsed * (100 - progress) / progress
+
+        expected = self.expected_duration(task.endpoint)
+        if expected is not None and expected > elapsed:
+            if remaining is None:
+                remaining = expected - elapsed
             else:
-                # Estado desconocido
-                print(f"Unknown status '{status}' for task {task_id}, retrying...")
-                wait_time = min(2 ** attempt + 5, 60)
-                time.sleep(wait_time)
+                remaining = (remaining + expected - elapsed) / 2
+
+        if remaining is None:
+            # Sin información sobre la tarea: espaciar las consultas poco a poco
+            return self._clamp(self.initial_delay * 1.5 ** task.polls)
+
+        # Consultar a mitad del tiempo restante previsto para acercarse sin pasarse
+        return self._clamp(remaining / 2)
+
+    def error_delay(self, errors):
+        return self._clamp(self.min_interval * 2 ** errors)
+
+    def _clamp(self, delay):
+        return max(self.min_interval, min(self.max_interval, delay))
+
+class PollingTask:
+    def __init__(self, task_id, output_format, api_key, endpoint, timeout, started_at, max_size=None, cache_key=None, span=None, lazy=False, polling_url=None):
+        self.task_id = task_id
+        self.polling_url = polling_url
+        self.lazy = lazy
+        self.span = span or JobSpan(endpoint)
+        self.generation_started = None
+        self.output_format = output_format
+        self.max_size = max_size
+        self.cache_key = cache_key
+        self.api_key = api_key
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.started_at = started_at
+        self.deadline = started_at + timeout
+        self.polls = 0
+        self.errors = 0
+        self.completing = False
+        self.future = concurrent.futures.Future()
+
+class BFLPollingEngine:
+    # Motor de polling en segundo plano: un único event loop es dueño de todas las
+    # tareas en curso y reparte las llamadas a get_result entre ellas, de modo que
+    # ningún hilo de ComfyUI queda bloqueado en time.sleep por cada tarea
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance.setup()
+                    cls._instance = instance
+        return cls._instance
+
+    def setup(self):
+        config = BFLConfigLoader()
+        self.max_concurrent_polls = config.get_int('POLLING', 'MAX_CONCURRENT_POLLS', 8)
+        self.poll_spacing = config.get_float('POLLING', 'POLL_SPACING', 0.05)
+        self.scheduler = PollScheduler()
+        # Con webhooks el polling queda como respaldo lento
+        webhook = BFLWebhookReceiver()
+        self.fallback_interval = webhook.fallback_interval if webhook.enabled else 0.0
+        self.early_callbacks = collections.OrderedDict()
+
+        self.tasks = {}
+        self._queue = []
+        self._counter = itertools.count()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_concurrent_polls,
+            thread_name_prefix="bfl-poll"
+        )
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run_loop, name="bfl-polling-engine", daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _start(self):
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self.max_concurrent_polls)
+        self.loop.create_task(self._scheduler())
+
+    def submit(self, task_id, output_format, api_key=None, endpoint=None, timeout=None, max_size=None, cache_key=None, span=None, lazy=False, polling_url=None):
+        # Devuelve un concurrent.futures.Future que se resuelve con el BFLResult.
+        # api_key debe ser la key con la que se envió la tarea y polling_url la URL
+        # de consulta que devolvió la API
+        task = PollingTask(
+            task_id, output_format, api_key, endpoint,
+            self.scheduler.timeout_for(timeout), time.monotonic(), max_size, cache_key, span, lazy, polling_url
+        )
+        self.loop.call_soon_threadsafe(self._register, task)
+        return task.future
+
+    def pending_count(self):
+        return len(self.tasks)
+
+    def _register(self, task):
+        self.tasks[task.task_id] = task
+        self._schedule(task, max(self.fallback_interval, self.scheduler.first_delay(task.endpoint)))
+        data = self.early_callbacks.pop(task.task_id, None)
+        if data is not None:
+            self._apply_status(task, data, 'webhook')
+
+    def notify(self, task_id, data):
+        # Aviso de finalización recibido por webhook (desde cualquier hilo)
+        self.loop.call_soon_threadsafe(self._on_callback, task_id, data)
+
+    def _on_callback(self, task_id, data):
+        task = self.tasks.get(task_id)
+        if task is None:
+            # El aviso puede llegar antes de que la respuesta del envío registre la tarea
+            self.early_callbacks[task_id] = data
+            while len(self.early_callbacks) > 1000:
+                self.early_callbacks.popitem(last=False)
+            return
+        self._apply_status(task, data, 'webhook')
+
+    def _apply_status(self, task, data, source):
+        if task.completing or task.future.done():
+            return
+        try:
+            sample_url = parse_task_status(task.task_id, data)
+        except Exception as e:
+            self._finish(task, error=Exception(f"Error processing task {task.task_id}: {str(e)}"))
+            return
+        if sample_url is not None:
+            self.loop.create_task(self._complete(task, sample_url, source))
+
+    def _schedule(self, task, delay):
+        # Nunca dormir más allá del plazo de la tarea
+        delay = max(0, min(delay, task.deadline - time.monotonic()))
+        heapq.heappush(self._queue, (self.loop.time() + delay, next(self._counter), task))
+        self._wakeup.set()
+
+    def _finish(self, task, result=None, error=None):
+        self.tasks.pop(task.task_id, None)
+        task.span.set('polls', task.polls)
+        task.span.finish('error' if error is not None else 'ok', error)
+        if task.future.done():
+            return
+        if error is not None:
+            task.future.set_exception(error)
+        else:
+            task.future.set_result(result)
+
+    async def _scheduler(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
                 continue
-        
-        except requests.exceptions.Timeout:
-            print(f"Timeout on attempt {attempt + 1}/{max_attempts} for task {task_id}")
-            if attempt == max_attempts - 1:
-                raise Exception(f"Request timeout after {max_attempts} attempts")
-            wait_time = min(2 ** attempt + 5, 60)
-            time.sleep(wait_time)
-            continue
-        
-        except requests.exceptions.RequestException as e:
-            print(f"Request error on attempt {attempt + 1}/{max_attempts}: {str(e)}")
-            if attempt == max_attempts - 1:
-                raise Exception(f"Request failed after {max_attempts} attempts: {str(e)}")
-            wait_time = min(2 ** attempt + 5, 60)
-            time.sleep(wait_time)
-            continue
-        
+
+            delay = self._queue[0][0] - self.loop.time()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Recoger en un mismo lote todas las tareas cuyo turno ya llegó y
+            # espaciar las peticiones para no enviarlas en ráfaga
+            now = self.loop.time()
+            batch = []
+            while self._queue and self._queue[0][0] <= now:
+                batch.append(heapq.heappop(self._queue)[2])
+
+            for index, task in enumerate(batch):
+                if index and self.poll_spacing > 0:
+                    await asyncio.sleep(self.poll_spacing)
+                self.loop.create_task(self._poll(task))
+
+    def _timed_out(self, task):
+        if time.monotonic() < task.deadline:
+            return False
+        self._finish(task, error=Exception(f"Task {task.task_id} timed out after {task.timeout:.0f}s"))
+        return True
+
+    def _retry_after_error(self, task, error):
+        task.errors += 1
+        print(f"Request error polling task {task.task_id} ({task.errors}/{self.scheduler.max_errors}): {str(error)}")
+        if task.errors >= self.scheduler.max_errors:
+            self._finish(task, error=Exception(f"Request failed after {task.errors} attempts: {str(error)}"))
+        elif not self._timed_out(task):
+            self._schedule(task, self.scheduler.error_delay(task.errors))
+
+    async def _poll(self, task):
+        if task.future.cancelled():
+            self.tasks.pop(task.task_id, None)
+            return
+        if task.completing or task.future.done():
+            return
+
+        task.polls += 1
+        async with self._semaphore:
+            try:
+                data = await self.loop.run_in_executor(
+                    self.executor, fetch_task_status, task.task_id, task.api_key, task.polling_url
+                )
+                sample_url = parse_task_status(task.task_id, data)
+
+            except requests.exceptions.HTTPError as e:
+                if e.response is not None and e.response.status_code == 429:
+                    # Un 429 en el polling no es un fallo de la tarea: esperar lo que indique la API
+                    delay = parse_retry_after(e.response.headers.get('Retry-After'))
+                    if not self._timed_out(task):
+                        self._schedule(task, delay if delay is not None else self.scheduler.max_interval)
+                    return
+                self._retry_after_error(task, e)
+                return
+
+            except requests.exceptions.RequestException as e:
+                self._retry_after_error(task, e)
+                return
+
+            except Exception as e:
+                # Para otros errores (parsing JSON, estados de error, etc.), fallar inmediatamente
+                self._finish(task, error=Exception(f"Error processing task {task.task_id}: {str(e)}"))
+                return
+
+        task.errors = 0
+        now = time.monotonic()
+
+        if sample_url is None:
+            # Tarea en progreso, continuar polling
+            progress = data.get('progress')
+            if not isinstance(progress, (int, float)):
+                progress = None
+            if progress and task.generation_started is None:
+                task.generation_started = now
+            print(f"Task {task.task_id} in progress: {progress or 0}% (poll {task.polls}, {now - task.started_at:.1f}s)")
+            if not self._timed_out(task):
+                self._schedule(task, max(self.fallback_interval, self.scheduler.next_delay(task, progress, now)))
+            return
+
+        await self._complete(task, sample_url, 'poll')
+
+    async def _complete(self, task, sample_url, source):
+        # Un aviso por webhook y una consulta pueden detectar el final a la vez
+        if task.completing or task.future.done():
+            return
+        task.completing = True
+        task.span.set('completed_by', source)
+        now = time.monotonic()
+        self.scheduler.record_completion(task.endpoint, now - task.started_at)
+        # Sin progreso observado no se puede separar la cola de la generación
+        generation_started = task.generation_started or now
+        task.span.add('queue', generation_started - task.started_at)
+        task.span.add('generation', now - generation_started)
+
+        # La descarga y decodificación se hace en el pool de descargas, fuera del
+        # semáforo y de los hilos de polling
+        try:
+            result = await self.loop.run_in_executor(
+                BFLDownloader().executor, download_result, sample_url, task.max_size, task.cache_key, task.span, task.lazy
+            )
+            self._finish(task, result=result)
         except Exception as e:
-            # Para otros errores (parsing JSON, etc.), lanzar inmediatamente
-            raise Exception(f"Error processing task {task_id}: {str(e)}")
-    
-    raise Exception(f"Max polling attempts ({max_attempts}) reached for task {task_id}")
+            self._finish(task, error=Exception(f"Error processing task {task.task_id}: {str(e)}"))
 
-def create_error_image():
-    blank = Image.new('RGB', (512, 512), color='red')
-    blank.putpixel((256, 256), (255, 0, 0))
+def create_error_image(width=512, height=512):
+    blank = Image.new('RGB', (width, height), color='red')
+    blank.putpixel((width // 2, height // 2), (255, 0, 0))
     tensor = torch.from_numpy(np.array(blank).astype(np.float32) / 255.0)
-    return tensor[None,]
\ No newline at end of file
+    return tensor[None,]
+
+def parse_sweep_value(text):
+    text = text.strip()
+    if text.lower() in ('true', 'false'):
+        return text.lower() == 'true'
+    for cast in (int, float):
+        try:
+            return cast(text)
+        except ValueError:
+            pass
+    return text.strip('"\'')
+
+def parse_sweep(text, max_jobs=None):
+    # Una línea por parámetro: "nombre = v1, v2, v3", "nombre = inicio..fin" (enteros
+    # consecutivos) o "nombre = inicio..fin:n" (n valores equiespaciados). Con
+    # max_jobs se rechaza una matriz con más trabajos antes de construirla
+    axes = []
+    total = 1
+    for line in text.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        if '=' not in line:
+            raise Exception(f"Invalid sweep line '{line}': expected 'name = values'")
+        name, spec = (part.strip() for part in line.split('=', 1))
+
+        if '..' in spec:
+            start_text, _, rest = spec.partition('..')
+            end_text, _, count_text = rest.partition(':')
+            start, end = parse_sweep_value(start_text), parse_sweep_value(end_text)
+            if count_text.strip():
+                count = max(1, int(count_text))
+            elif isinstance(start, int) and isinstance(end, int):
+                count = max(0, end - start + 1)
+            else:
+                raise Exception(f"Sweep range '{spec}' for '{name}' is not integer: give the number of values with ':n'")
+            if max_jobs is not None and total * count > max_jobs:
+                raise Exception(f"Sweep would run at least {total * count} jobs, the limit is {max_jobs} (raise [SWEEP] MAX_JOBS to allow it)")
+
+            if count_text.strip():
+                values = [start + (end - start) * index / max(1, count - 1) for index in range(count)]
+                if isinstance(start, int) and isinstance(end, int):
+                    values = [round(value) for value in values]
+                else:
+                    values = [round(value, 4) for value in values]
+            else:
+                values = list(range(start, end + 1))
+        else:
+            values = [parse_sweep_value(value) for value in spec.split(',') if value.strip()]
+
+        if not values:
+            raise Exception(f"No values for sweep parameter '{name}'")
+        total *= len(values)
+        if max_jobs is not None and total > max_jobs:
+            raise Exception(f"Sweep would run at least {total} jobs, the limit is {max_jobs} (raise [SWEEP] MAX_JOBS to allow it)")
+        axes.append((name, values))
+    return axes
+
+def expand_sweep(axes):
+    # Matriz de trabajos en orden de rejilla: el primer parámetro varía por columnas
+    # (el más rápido) y los siguientes por filas
+    names = [name for name, _ in reversed(axes)]
+    combos = itertools.product(*[values for _, values in reversed(axes)])
+    return [dict(zip(names, combo)) for combo in combos]
+
+def contact_sheet(images, labels, columns, max_cell=384, line_height=12):
+    # Hoja de contactos con una etiqueta (una línea por parámetro) encima de cada
+    # imagen del lote. El texto se recorta al ancho de su celda
+    count, height, width = images.shape[:3]
+    scale = min(1.0, max_cell / max(height, width))
+    cell_width, cell_height = max(1, round(width * scale)), max(1, round(height * scale))
+    cells = torch.nn.functional.interpolate(
+        images[..., :3].movedim(-1, 1), size=(cell_height, cell_width), mode='area'
+    ).movedim(1, -1)
+    cells = cells.mul(255).clamp_(0, 255).to(torch.uint8).numpy()
+
+    label_height = line_height * max((label.count("\n") + 1 for label in labels), default=1) + 6
+    columns = max(1, min(columns, count))
+    rows = math.ceil(count / columns)
+    sheet = Image.new('RGB', (columns * cell_width, rows * (cell_height + label_height)), 'white')
+    for index, (cell, label) in enumerate(zip(cells, labels)):
+        x = (index % columns) * cell_width
+        y = (index // columns) * (cell_height + label_height)
+        caption = Image.new('RGB', (cell_width, label_height), 'white')
+        ImageDraw.Draw(caption).multiline_text((3, 3), label, fill=(0, 0, 0), spacing=2)
+        sheet.paste(caption, (x, y))
+        sheet.paste(Image.fromarray(cell), (x, y + label_height))
+    return image_to_tensor(sheet)